@@ -0,0 +1,2 @@
+# Offline benchmarks for the prepare hot paths. Run as modules, e.g.
+#   python -m newsbot.bench.ingest
@@ -0,0 +1,161 @@
+"""Benchmark the caption stage against the mock LLM server (mock_llm.py).
+
+Stories are captioned the way prepare() does it -- MAX_ITEMS_PER_RUN at a
+time through caption.write_captions() -- with the real SDK clients, health
+board, rate limits and JSON repair, but every request goes to a local mock
+with the latency and failure mix given on the command line. Each scenario
+is a batch size / worker count pair, so batching and concurrency changes can
+be compared side by side:
+
+  python -m newsbot.bench.captions
+  python -m newsbot.bench.captions --stories 60 --rate-429 0.1 --malformed 0.1
+  python -m newsbot.bench.captions --dead-models gemini-3.6-flash --scenarios batched+concurrent
+
+Reported per scenario: stories captioned per minute, p50/p95 time from the
+start of a run until a story's caption is ready, provider requests per
+story (including SDK retries and fallbacks), and stories that failed.
+Nothing is cached between scenarios, and the caption cache is off.
+"""
+
+import argparse
+import contextlib
+import io
+import os
+import random
+import sys
+import tempfile
+import time
+
+from .. import caption, caption_cache, config, llm_clients, provider_health, ratelimit
+from . import mock_llm
+
+# name -> (CAPTION_BATCH_SIZE, CAPTION_WORKERS)
+SCENARIOS = {
+    "serial": (1, 1),
+    "batched": (5, 1),
+    "concurrent": (1, 4),
+    "batched+concurrent": (5, 4),
+}
+
+_WORDS = [
+    "सरकार", "मन्त्री", "संसद", "क्रिकेट", "फुटबल", "काठमाडौं", "प्रदेश", "निर्वाचन", "बजेट", "प्रहरी",
+    "government", "minister", "election", "cricket", "flood", "market", "court", "startup",
+]
+
+
+def _stories(count, rng):
+    stories = []
+    for n in range(count):
+        title = " ".join(rng.choice(_WORDS) for _ in range(rng.randint(5, 10)))
+        stories.append({
+            "title": f"{title} {n}",
+            "summary": " ".join(rng.choice(_WORDS) for _ in range(rng.randint(20, 50))),
+            "link": f"https://example.com/{n}",
+            "source": "Bench",
+            "category": "general",
+        })
+    return stories
+
+
+class _TimingCache(caption_cache.CaptionCache):
+    """A disabled cache that notes when each story's caption was stored --
+    write_captions() puts every result the moment it has it."""
+
+    def __init__(self):
+        super().__init__(os.devnull, 0, 0)
+        self.ready = {}
+
+    def put(self, prompt, model_id, result):
+        self.ready[prompt] = time.perf_counter()
+
+
+def _percentile(values, pct):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+def run_scenario(name, stories, settings, url, run_size, rate_limits, tmp_dir):
+    batch_size, workers = SCENARIOS[name]
+    config.CAPTION_BATCH_SIZE, config.CAPTION_WORKERS = batch_size, workers
+    config.LLM_MOCK_URL = url
+    if not rate_limits:
+        config.GEMINI_RPM = config.GEMINI_TPM = config.GROQ_RPM = config.GROQ_TPM = [0]
+    # Fresh clients, limits and health for every scenario.
+    llm_clients._clients.clear()
+    ratelimit._limiters.clear()
+    provider_health._board = provider_health.HealthBoard(os.path.join(tmp_dir, f"health-{name}.json"))
+    timing = _TimingCache()
+    caption_cache._cache = timing
+
+    requests_before = settings.requests
+    latencies, failed = [], 0
+    started = time.perf_counter()
+    for i in range(0, len(stories), run_size):
+        run = stories[i:i + run_size]
+        run_started = time.perf_counter()
+        results = caption.write_captions(run)
+        for story, result in zip(run, results):
+            ready = timing.ready.get(caption.build_prompt(story))
+            if isinstance(result, Exception) or ready is None:
+                failed += 1
+            else:
+                latencies.append(ready - run_started)
+    elapsed = time.perf_counter() - started
+
+    done = len(stories) - failed
+    return {
+        "stories_per_min": done / elapsed * 60 if elapsed else 0.0,
+        "p50": _percentile(latencies, 50),
+        "p95": _percentile(latencies, 95),
+        "calls_per_story": (settings.requests - requests_before) / len(stories),
+        "failed": failed,
+        "seconds": elapsed,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--stories", type=int, default=45)
+    parser.add_argument("--run-size", type=int, default=config.MAX_ITEMS_PER_RUN,
+                        help="stories per write_captions() call, like one prepare run")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="comma-separated, from: " + ", ".join(SCENARIOS))
+    parser.add_argument("--gemini-keys", type=int, default=2)
+    parser.add_argument("--groq-keys", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="show the caption/health log lines")
+    parser.add_argument("--rate-limits", action="store_true",
+                        help="keep the configured per-key RPM/TPM limits (off by default: the mock has no quota)")
+    mock_llm.add_arguments(parser)
+    args = parser.parse_args()
+
+    # Any key works against the mock; the SDKs' own retries stay as in
+    # production and show up in calls/story.
+    config.GEMINI_API_KEYS = [f"mock-gemini-{n}" for n in range(1, args.gemini_keys + 1)]
+    config.GROQ_API_KEYS = [f"mock-groq-{n}" for n in range(1, args.groq_keys + 1)]
+    config.LLM_PREWARM = False
+
+    settings = mock_llm.settings_from_args(args)
+    server, url = mock_llm.start(settings)
+    stories = _stories(args.stories, random.Random(args.seed))
+    print(
+        f"{args.stories} stories in runs of {args.run_size}; mock latency {args.latency_ms:.0f} ms "
+        f"(sigma {args.jitter}), 429 {args.rate_429:.0%}, 500 {args.rate_500:.0%}, "
+        f"malformed {args.malformed:.0%}, truncated {args.truncated:.0%}"
+    )
+    print(f"{'scenario':<20}{'stories/min':>12}{'p50 s':>8}{'p95 s':>8}{'calls/story':>13}{'failed':>8}{'total s':>9}")
+    try:
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            for name in [s for s in args.scenarios.split(",") if s]:
+                with contextlib.redirect_stdout(sys.stdout if args.verbose else io.StringIO()):
+                    r = run_scenario(name, stories, settings, url, args.run_size, args.rate_limits, tmp_dir)
+                print(
+                    f"{name:<20}{r['stories_per_min']:>12,.0f}{r['p50']:>8.2f}{r['p95']:>8.2f}"
+                    f"{r['calls_per_story']:>13.2f}{r['failed']:>8}{r['seconds']:>9.1f}"
+                )
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
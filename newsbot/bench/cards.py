@@ -0,0 +1,328 @@
+"""Benchmark card rendering and check the cards against golden images.
+
+Every card in the corpus (card_corpus.json: real headline/caption pairs
+from the daily digest -- short, long, mixed Devanagari/Latin, numbers,
+quotes, an unbreakable word, no caption) is rendered and encoded
+--repeat times the way prepare() does it. Reported per card: the first
+(cold cache) and median render+encode time, the font-fit layouts tried
+for both text blocks, the encoded size and quality, and the saving over
+the old quality-92 JPEG.
+
+Each encoded card is also decoded, shrunk to GOLDEN_SIZE in greyscale
+and compared with its golden PNG in card_goldens/. A card fails when the
+mean pixel difference is over --threshold or more than
+CHANGED_PIXELS_LIMIT of the pixels changed by more than CHANGED_PIXEL_DELTA:
+JPEG noise from a different quality stays well under both, a line wrapped
+differently or a font one size off does not.
+
+  python -m newsbot.bench.cards
+  python -m newsbot.bench.cards --check           # exit 1 if a card drifted
+  python -m newsbot.bench.cards --save-goldens    # after an intended change
+  python -m newsbot.bench.cards --corpus newsbot/data/digest_today.json --repeat 1
+  python -m newsbot.bench.cards --exact           # layout vs the reference code
+
+--exact checks what the thumbnails can't: that the memoised text layout
+(card_image._wrap_text / _fit_block) gives exactly what measuring every
+trial line did. Every corpus card and --samples random blocks made of the
+corpus words are laid out with both, and cards are rendered with both and
+compared pixel for pixel at full size. With --require-shaping it also fails
+unless Pillow has raqm and the fonts have Devanagari glyphs, as in CI --
+otherwise complex-script shaping, where the two could differ, never runs.
+
+Goldens only hold for the fonts they were rendered with (recorded in
+card_goldens/goldens.json): with other fonts installed, or no goldens at
+all, --check fails rather than passing without comparing anything. Cards are
+rendered with Noto Sans Devanagari (fonts-noto-core) in CI, and
+--save-goldens refuses fonts without Devanagari glyphs, whose cards would be
+all boxes. The card-goldens workflow re-saves them with the CI fonts.
+"""
+
+import argparse
+import io
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+from PIL import Image, ImageChops, ImageDraw, features
+
+from .. import card_image
+
+CORPUS_FILE = os.path.join(os.path.dirname(__file__), "card_corpus.json")
+GOLDENS_DIR = os.path.join(os.path.dirname(__file__), "card_goldens")
+GOLDEN_SIZE = (216, 216)
+# Mean absolute greyscale difference (0-255) allowed against a golden.
+DIFF_THRESHOLD = 1.5
+CHANGED_PIXEL_DELTA = 48
+CHANGED_PIXELS_LIMIT = 0.005
+# What every card used to be saved as; the savings are reported against it.
+LEGACY_JPEG_QUALITY = 92
+
+
+def load_corpus(path):
+    """Cards from a card_corpus.json- or digest_today.json-style list: each
+    entry has headline_ne + caption_ne, or just digest_line_ne."""
+    with open(path, "r", encoding="utf-8") as f:
+        entries = json.load(f)
+    corpus = []
+    for n, entry in enumerate(entries):
+        line = entry.get("digest_line_ne", "")
+        corpus.append({
+            "name": entry.get("name") or f"card{n}",
+            "headline_ne": entry.get("headline_ne") or line,
+            "caption_ne": entry.get("caption_ne", line),
+        })
+    return corpus
+
+
+def _fonts():
+    return [
+        card_image._font_path(tuple(card_image.FONT_BOLD_CANDIDATES)),
+        card_image._font_path(tuple(card_image.FONT_REGULAR_CANDIDATES)),
+    ]
+
+
+def _glyph(font, text):
+    img = Image.new("L", (64, 64))
+    ImageDraw.Draw(img).text((4, 4), text, font=font, fill=255)
+    return img.tobytes()
+
+
+def fonts_without_devanagari():
+    """The card fonts that draw Devanagari as the missing-glyph box."""
+    missing = []
+    for path in _fonts():
+        font = card_image._truetype(path, 40)
+        if _glyph(font, "क") == _glyph(font, "\ue000"):
+            missing.append(path)
+    return missing
+
+
+def _reference_wrap_text(draw, text, font, max_width):
+    """card_image._wrap_text as it was before the width cache: every trial
+    line is measured in full."""
+    words = text.split()
+    lines, current = [], ""
+    for word in words:
+        trial = f"{current} {word}".strip()
+        if draw.textlength(trial, font=font) <= max_width:
+            current = trial
+        else:
+            if current:
+                lines.append(current)
+            current = word
+    if current:
+        lines.append(current)
+    return lines or [text]
+
+
+def _reference_fit_block(draw, text, max_width, max_height, bold, start_size, min_size, line_gap_ratio=1.3):
+    """card_image._fit_block as it was: every size from start_size down."""
+    candidates = card_image.FONT_BOLD_CANDIDATES if bold else card_image.FONT_REGULAR_CANDIDATES
+    size = start_size
+    while size >= min_size:
+        font = card_image._load_font(candidates, size)
+        lines = _reference_wrap_text(draw, text, font, max_width)
+        line_height = int(size * line_gap_ratio)
+        if line_height * len(lines) <= max_height:
+            return font, lines, line_height
+        size -= 4
+    font = card_image._load_font(candidates, min_size)
+    return font, _reference_wrap_text(draw, text, font, max_width), int(min_size * line_gap_ratio)
+
+
+def _reference_draw_centered_block(draw, lines, font, line_height, zone_top, zone_bottom, fill):
+    y = zone_top + max(0, (zone_bottom - zone_top - line_height * len(lines)) // 2)
+    for line in lines:
+        w = draw.textlength(line, font=font)
+        draw.text(((card_image.WIDTH - w) / 2, y), line, font=font, fill=fill)
+        y += line_height
+
+
+def reference_render(headline, subtitle):
+    """render_card() with the reference layout code."""
+    saved = card_image._fit_block, card_image._draw_centered_block
+    card_image._fit_block, card_image._draw_centered_block = _reference_fit_block, _reference_draw_centered_block
+    try:
+        return card_image.render_card(headline, subtitle)
+    finally:
+        card_image._fit_block, card_image._draw_centered_block = saved
+
+
+def check_exact(corpus, samples, seed=1):
+    """Lay out and render with both the current and the reference code;
+    returns (texts laid out, cards rendered, descriptions of differences)."""
+    rng = random.Random(seed)
+    words = [w for card in corpus for text in (card["headline_ne"], card["caption_ne"]) for w in text.split()]
+    cards = [(card["headline_ne"], card["caption_ne"]) for card in corpus]
+    for _ in range(samples):
+        cards.append((
+            " ".join(rng.choice(words) for _ in range(rng.randint(1, 20))),
+            " ".join(rng.choice(words) for _ in range(rng.randint(1, 80))),
+        ))
+    draw = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+    blocks = (
+        (0, True, card_image.TITLE_SIZES, card_image.TITLE_BOTTOM - card_image.TITLE_TOP),
+        (1, False, card_image.SUBTITLE_SIZES, card_image.SUBTITLE_BOTTOM - card_image.SUBTITLE_TOP),
+    )
+    differences = []
+    for n, card in enumerate(cards):
+        for index, bold, (start, min_size), height in blocks:
+            args = (draw, card[index], card_image.TEXT_MAX_WIDTH, height, bold, start, min_size)
+            new, old = card_image._fit_block(*args), _reference_fit_block(*args)
+            if (new[0].size, new[1], new[2]) != (old[0].size, old[1], old[2]):
+                differences.append(f"layout of {card[index][:40]!r}: {new[0].size}px {new[1]} vs {old[0].size}px {old[1]}")
+        # Rendering is the slow part; the layouts above cover the rest.
+        if n < len(corpus) + min(samples, 100):
+            if ImageChops.difference(card_image.render_card(*card), reference_render(*card)).getbbox():
+                differences.append(f"pixels of card {card[0][:40]!r}")
+    return len(cards) * len(blocks), min(len(cards), len(corpus) + 100), differences
+
+
+def _thumbnail(path):
+    return Image.open(path).convert("L").resize(GOLDEN_SIZE, Image.BOX)
+
+
+def compare(thumb, golden):
+    """(mean difference, share of changed pixels) between two thumbnails."""
+    diff = ImageChops.difference(thumb, golden)
+    histogram = diff.histogram()
+    pixels = GOLDEN_SIZE[0] * GOLDEN_SIZE[1]
+    mean = sum(value * count for value, count in enumerate(histogram)) / pixels
+    changed = sum(histogram[CHANGED_PIXEL_DELTA + 1:]) / pixels
+    return mean, changed
+
+
+def legacy_bytes(img):
+    """Size of `img` as the old baseline quality-92 JPEG."""
+    buf = io.BytesIO()
+    img.save(buf, "JPEG", quality=LEGACY_JPEG_QUALITY)
+    return len(buf.getvalue())
+
+
+def render(card, path, repeat):
+    """Render + encode one card `repeat` times; returns its timings, the
+    layouts _fit_block tried on the first render, and write_card's stats
+    plus the card's legacy_bytes (measured outside the timings)."""
+    wrap_text = card_image._wrap_text
+    layouts = []
+
+    def counting_wrap(*args, **kwargs):
+        layouts.append(1)
+        return wrap_text(*args, **kwargs)
+
+    timings = []
+    card_image._wrap_text = counting_wrap
+    try:
+        for n in range(repeat):
+            started = time.perf_counter()
+            img = card_image.render_card(card["headline_ne"], card["caption_ne"])
+            stats = card_image.write_card(img, path)
+            timings.append(time.perf_counter() - started)
+            if n == 0:
+                fit_layouts = len(layouts)
+    finally:
+        card_image._wrap_text = wrap_text
+    stats["legacy_bytes"] = legacy_bytes(img)
+    return timings, fit_layouts, stats
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--corpus", default=CORPUS_FILE)
+    parser.add_argument("--repeat", type=int, default=5, help="renders per card")
+    parser.add_argument("--threshold", type=float, default=DIFF_THRESHOLD, help="max mean pixel difference")
+    parser.add_argument("--save-goldens", action="store_true")
+    parser.add_argument("--check", action="store_true", help="exit 1 if any card differs from its golden")
+    parser.add_argument("--exact", action="store_true", help="compare the text layout with the reference code instead")
+    parser.add_argument("--samples", type=int, default=1000, help="random text blocks for --exact")
+    parser.add_argument("--require-shaping", action="store_true", help="with --exact, fail without raqm and Devanagari fonts")
+    args = parser.parse_args()
+
+    corpus = load_corpus(args.corpus)
+    if args.exact:
+        raqm, missing = features.check("raqm"), fonts_without_devanagari()
+        print(f"Fonts {_fonts()}, raqm {'on' if raqm else 'off'}")
+        if missing:
+            print(f"No Devanagari glyphs in: {', '.join(missing)}")
+        texts, rendered, differences = check_exact(corpus, max(0, args.samples))
+        for difference in differences[:20]:
+            print(f"DIFFERS: {difference}")
+        print(f"{texts} text block(s) laid out, {rendered} card(s) compared at full size: {len(differences)} difference(s)")
+        if differences or (args.require_shaping and (not raqm or missing)):
+            sys.exit(1)
+        return
+    meta_path = os.path.join(GOLDENS_DIR, "goldens.json")
+    meta = {}
+    if os.path.exists(meta_path):
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+    if args.save_goldens and fonts_without_devanagari():
+        print(f"Not saving goldens, no Devanagari glyphs in: {', '.join(fonts_without_devanagari())}")
+        sys.exit(1)
+    compare_goldens = not args.save_goldens and meta.get("fonts") == _fonts()
+    if not meta and not args.save_goldens:
+        print(f"No goldens in {GOLDENS_DIR}: not comparing")
+    elif not compare_goldens and not args.save_goldens:
+        print(f"Goldens were rendered with {meta.get('fonts')}, these fonts are {_fonts()}: not comparing")
+
+    print(
+        f"{'card':<16}{'first ms':>10}{'median ms':>11}{'fits':>6}{'bytes':>9}{'q':>4}"
+        f"{'saved':>8}{'diff':>7}{'changed':>9}  result"
+    )
+    failures, total_ms, total_bytes, total_legacy = [], [], 0, 0
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for card in corpus:
+            path = os.path.join(tmp_dir, card["name"] + card_image.card_extension())
+            timings, fit_layouts, stats = render(card, path, max(1, args.repeat))
+            total_ms.extend(t * 1000 for t in timings)
+            total_bytes += stats["bytes"]
+            total_legacy += stats["legacy_bytes"]
+            thumb = _thumbnail(path)
+            golden_path = os.path.join(GOLDENS_DIR, f"{card['name']}.png")
+            diff = changed = None
+            result = ""
+            if args.save_goldens:
+                os.makedirs(GOLDENS_DIR, exist_ok=True)
+                thumb.save(golden_path, optimize=True)
+                result = "saved"
+            elif not compare_goldens:
+                result = "-"
+            elif not os.path.exists(golden_path):
+                result = "no golden"
+                failures.append(card["name"])
+            else:
+                diff, changed = compare(thumb, Image.open(golden_path).convert("L"))
+                if diff > args.threshold or changed > CHANGED_PIXELS_LIMIT:
+                    result = "DIFFERS"
+                    failures.append(card["name"])
+                else:
+                    result = "ok"
+            print(
+                f"{card['name'][:15]:<16}{timings[0] * 1000:>10.1f}{statistics.median(timings) * 1000:>11.1f}"
+                f"{fit_layouts:>6}{stats['bytes']:>9,}{stats['quality']:>4}"
+                f"{1 - stats['bytes'] / stats['legacy_bytes']:>8.0%}"
+                f"{'' if diff is None else f'{diff:.2f}':>7}{'' if changed is None else f'{changed:.2%}':>9}  {result}"
+            )
+
+    print(
+        f"{len(corpus)} card(s): median {statistics.median(total_ms):.1f} ms/card, "
+        f"{total_bytes / 1024:.0f} KiB encoded ({(total_legacy - total_bytes) / 1024:.0f} KiB saved vs quality-"
+        f"{LEGACY_JPEG_QUALITY} JPEG)"
+    )
+    if args.save_goldens:
+        with open(meta_path, "w", encoding="utf-8") as f:
+            json.dump({"fonts": _fonts(), "size": list(GOLDEN_SIZE)}, f, indent=2)
+            f.write("\n")
+        print(f"Saved {len(corpus)} golden(s) to {GOLDENS_DIR}")
+    if failures:
+        print(f"Differs from (or has no) golden: {', '.join(failures)}")
+    if args.check and (failures or not (compare_goldens or args.save_goldens)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,254 @@
+"""Benchmark the ingest path: fetch_all, classify, already_posted, rank_key.
+
+Everything runs offline. Synthetic RSS feeds are written to a temporary
+fixture directory and fetch_all() replays them (FEED_FIXTURES_MODE=replay),
+so network time is excluded and only parse/filter/classify cost remains.
+Each scale multiplies both the number of feeds (13 today) and the history
+size (MAX_HISTORY_ENTRIES today).
+
+  python -m newsbot.bench.ingest                    # compare to the baseline
+  python -m newsbot.bench.ingest --scales 1,10,100
+  python -m newsbot.bench.ingest --save-baseline    # after an intended change
+  python -m newsbot.bench.ingest --check            # exit 1 on a regression
+
+Every run also checks that stream_feeds() hands over every feed that
+downloaded in time to a consumer slower than the fetch deadline (prepare()
+captions urgent stories between feeds), with parallel and serial fetching.
+
+The stored baseline (baseline_ingest.json) is only meaningful on the
+machine that wrote it -- re-save it before comparing on a new machine.
+
+To benchmark against real feed content instead, record it once with
+FEED_FIXTURES_MODE=record python -m newsbot.main --phase prepare, then pass
+--fixtures newsbot/bench/fixtures (scale 1 only).
+"""
+
+import argparse
+import hashlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+from email.utils import formatdate
+from xml.sax.saxutils import escape
+
+from .. import config, fetch_news
+from ..dedupe import HistoryIndex, already_posted, item_hash
+from ..main import rank_key
+from ..rss_sources import FEEDS
+
+BASELINE_FILE = os.path.join(os.path.dirname(__file__), "baseline_ingest.json")
+ENTRIES_PER_FEED = 30
+# A stage counts as regressed when it is this much slower than the baseline.
+REGRESSION_RATIO = 1.25
+
+_WORDS_NE = [
+    "सरकार", "मन्त्री", "संसद", "क्रिकेट", "फुटबल", "काठमाडौं", "प्रदेश", "निर्वाचन", "बजेट", "प्रहरी",
+    "विद्यालय", "अस्पताल", "सडक", "पहिरो", "बाढी", "किसान", "बजार", "भाइरल", "प्रविधि", "नेपाल",
+]
+_WORDS_EN = [
+    "government", "minister", "election", "cricket", "football", "startup", "smartphone", "flood",
+    "market", "police", "school", "hospital", "viral", "hoax", "world", "talks", "deal", "court",
+]
+
+
+def _synthetic_feeds(scale):
+    feeds = []
+    for i in range(scale):
+        for feed in FEEDS:
+            feeds.append(dict(feed, name=f"{feed['name']} #{i}", url=f"{feed['url']}?bench={i}"))
+    return feeds
+
+
+def _write_fixtures(feeds, directory, rng):
+    now = time.time()
+    saved = config.FEED_FIXTURES_DIR
+    config.FEED_FIXTURES_DIR = directory
+    try:
+        for n, feed in enumerate(feeds):
+            words = _WORDS_NE if feed["lang"] == "ne" else _WORDS_EN
+            entries = []
+            for e in range(ENTRIES_PER_FEED):
+                title = " ".join(rng.choice(words) for _ in range(rng.randint(5, 10)))
+                summary = "<p>" + " ".join(rng.choice(words) for _ in range(rng.randint(20, 60))) + "</p>"
+                published = formatdate(now - rng.uniform(0, 48 * 3600), usegmt=True)
+                entries.append(
+                    f"<item><title>{escape(title)}</title><link>https://example.com/{n}/{e}</link>"
+                    f"<description>{escape(summary)}</description><pubDate>{published}</pubDate></item>"
+                )
+            body = (
+                '<?xml version="1.0" encoding="utf-8"?><rss version="2.0"><channel>'
+                f"<title>{escape(feed['name'])}</title>{''.join(entries)}</channel></rss>"
+            )
+            fetch_news._record_fixture(feed, body.encode("utf-8"), {"content-type": "application/rss+xml; charset=utf-8"})
+    finally:
+        config.FEED_FIXTURES_DIR = saved
+
+
+def _synthetic_history(size, items, rng):
+    # Roughly half of the fetched items were "already posted" in earlier runs.
+    records = [{"hash": hashlib.sha256(f"old-{i}".encode()).hexdigest(), "posted_at": 0} for i in range(size)]
+    for item in items:
+        if rng.random() < 0.5:
+            records[rng.randrange(size)] = {"hash": item_hash(item), "posted_at": 0}
+    return {"posted": records}
+
+
+def _measure(fn, memory=True, setup=None):
+    """Time fn() untraced, then (if `memory`) run it again under tracemalloc
+    for its peak allocation -- tracing slows feedparser down several times
+    over, so the two can't share a run."""
+    if setup:
+        setup()
+    start = time.perf_counter()
+    result = fn()
+    seconds = time.perf_counter() - start
+    peak = 0
+    if memory:
+        if setup:
+            setup()
+        tracemalloc.start()
+        fn()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    return result, seconds, peak
+
+
+def run_scale(scale, fixtures_dir=None, memory=True, seed=1):
+    rng = random.Random(seed)
+    saved = (fetch_news.FEEDS, config.FEED_FIXTURES_MODE, config.FEED_FIXTURES_DIR)
+    tmp = None
+    try:
+        if fixtures_dir:
+            feeds = FEEDS
+        else:
+            tmp = tempfile.TemporaryDirectory()
+            feeds = _synthetic_feeds(scale)
+            _write_fixtures(feeds, tmp.name, rng)
+            fixtures_dir = tmp.name
+        fetch_news.FEEDS = feeds
+        config.FEED_FIXTURES_MODE = "replay"
+        config.FEED_FIXTURES_DIR = fixtures_dir
+
+        stages = {}
+        items, secs, peak = _measure(lambda: fetch_news.fetch_all(max_age_hours=36, deadline=3600), memory)
+        stages["fetch_all"] = (len(items), secs, peak)
+
+        _, secs, peak = _measure(lambda: fetch_news.classify_many(items), memory)
+        stages["classify"] = (len(items), secs, peak)
+
+        history = _synthetic_history(config.MAX_HISTORY_ENTRIES * scale, items, rng)
+        index, secs, peak = _measure(lambda: HistoryIndex(history), memory)
+        stages["history_index"] = (len(history["posted"]), secs, peak)
+
+        def forget_hashes():
+            for item in items:
+                item.pop("_hash", None)
+
+        unseen, secs, peak = _measure(
+            lambda: [it for it in items if not already_posted(it, index)], memory, setup=forget_hashes,
+        )
+        stages["already_posted"] = (len(items), secs, peak)
+
+        _, secs, peak = _measure(lambda: sorted(unseen, key=rank_key), memory)
+        stages["rank_sort"] = (len(unseen), secs, peak)
+    finally:
+        fetch_news.FEEDS, config.FEED_FIXTURES_MODE, config.FEED_FIXTURES_DIR = saved
+        if tmp is not None:
+            tmp.cleanup()
+
+    return {
+        name: {
+            "n": n,
+            "seconds": round(secs, 6),
+            "per_sec": round(n / secs, 1) if secs else None,
+            "peak_kib": round(peak / 1024, 1),
+        }
+        for name, (n, secs, peak) in stages.items()
+    }
+
+
+def check_slow_consumer(pause=0.2, deadline=1.0, seed=1):
+    """Consume the synthetic scale-1 feeds through stream_feeds(), sleeping
+    `pause` seconds per feed so the consumer outlasts `deadline`. Returns
+    {workers: feeds delivered} and the number of feeds."""
+    saved = (config.FEED_FIXTURES_MODE, config.FEED_FIXTURES_DIR)
+    delivered = {}
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        _write_fixtures(FEEDS, tmp_dir, random.Random(seed))
+        config.FEED_FIXTURES_MODE, config.FEED_FIXTURES_DIR = "replay", tmp_dir
+        try:
+            for workers in (config.FETCH_WORKERS, 1):
+                count = 0
+                for _ in fetch_news.stream_feeds(max_age_hours=36, workers=workers, deadline=deadline):
+                    count += 1
+                    time.sleep(pause)
+                delivered[workers] = count
+        finally:
+            config.FEED_FIXTURES_MODE, config.FEED_FIXTURES_DIR = saved
+    return delivered, len(FEEDS)
+
+
+def _load_baseline():
+    if not os.path.exists(BASELINE_FILE):
+        return {}
+    with open(BASELINE_FILE, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--scales", default="1,10", help="comma-separated feed/history multipliers")
+    parser.add_argument("--fixtures", help="replay recorded fixtures from this dir instead of synthetic feeds")
+    parser.add_argument("--save-baseline", action="store_true")
+    parser.add_argument("--check", action="store_true", help="exit 1 if any stage regressed vs. the baseline")
+    parser.add_argument("--no-memory", action="store_true", help="skip the (slow) tracemalloc peak-memory pass")
+    args = parser.parse_args()
+
+    scales = [1] if args.fixtures else [int(s) for s in args.scales.split(",") if s]
+    baseline = _load_baseline()
+    results = {}
+    regressions = []
+
+    print(f"{'scale':>5}  {'stage':<15}{'n':>9}{'ms':>11}{'per sec':>13}{'peak KiB':>11}  vs baseline")
+    for scale in scales:
+        key = f"x{scale}"
+        results[key] = run_scale(scale, args.fixtures, memory=not args.no_memory)
+        for stage, r in results[key].items():
+            base = baseline.get(key, {}).get(stage)
+            delta = ""
+            if base and base["seconds"]:
+                ratio = r["seconds"] / base["seconds"]
+                delta = f"{ratio:.2f}x time"
+                if ratio > REGRESSION_RATIO:
+                    delta += "  REGRESSION"
+                    regressions.append(f"{key}/{stage}")
+            print(
+                f"{key:>5}  {stage:<15}{r['n']:>9}{r['seconds'] * 1000:>11.1f}"
+                f"{r['per_sec'] or 0:>13,.0f}{r['peak_kib']:>11,.0f}  {delta}"
+            )
+
+    delivered, feeds = check_slow_consumer()
+    for workers, count in delivered.items():
+        status = "ok" if count == feeds else "FEEDS DROPPED"
+        print(f"slow consumer, {workers} worker(s): {count}/{feeds} feeds delivered  {status}")
+        if count != feeds:
+            regressions.append(f"slow-consumer/{workers}")
+
+    if args.save_baseline:
+        baseline.update(results)
+        with open(BASELINE_FILE, "w", encoding="utf-8") as f:
+            json.dump(baseline, f, indent=2, sort_keys=True)
+        print(f"Saved baseline to {BASELINE_FILE}")
+
+    if regressions:
+        print(f"Regressed vs. baseline: {', '.join(regressions)}")
+        if args.check:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,212 @@
+"""A local stand-in for the Gemini and Groq HTTP APIs.
+
+It answers the two requests caption.py makes -- Gemini's
+models/{model}:generateContent and Groq's OpenAI-style chat/completions --
+plus the model lookups llm_clients.prewarm() uses, with made-up Nepali
+captions in the shape the prompt asks for (single story or {"items": [...]}
+batch, full or digest-only). Latency, 429/500 error rates, malformed or
+truncated replies and retired model names are all configurable, so the
+caption stage can be load-tested without spending any quota.
+
+Point the bot at it with LLM_MOCK_URL (any API key works):
+
+  python -m newsbot.bench.mock_llm --port 8765 --latency-ms 800 --rate-429 0.05
+  LLM_MOCK_URL=http://127.0.0.1:8765 GEMINI_API_KEY=x python -m newsbot.main --phase prepare
+"""
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+_GEMINI_RE = re.compile(r"^/v1beta/models/([^/:]+):generateContent")
+_ITEM_RE = re.compile(r"--- Item id: (\S+)\nCategory.*\nSource.*\nOriginal title: (.*)")
+_TITLE_RE = re.compile(r"Original title: (.*)")
+
+
+class MockSettings:
+    def __init__(self, latency_ms=600, jitter=0.5, rate_429=0.0, rate_500=0.0,
+                 malformed=0.0, truncated=0.0, dead_models=(), significant=0.2, seed=None):
+        self.latency_ms = latency_ms    # median latency of one request
+        self.jitter = jitter            # lognormal sigma around that median
+        self.rate_429 = rate_429
+        self.rate_500 = rate_500
+        self.malformed = malformed      # fixable defects: fences, trailing commas, smart quotes
+        self.truncated = truncated      # reply cut off part-way through
+        self.dead_models = set(dead_models)
+        self.significant = significant
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+
+    def roll(self):
+        with self.lock:
+            self.requests += 1
+            return self.rng.random(), self.rng.random(), self.rng.lognormvariate(0, self.jitter)
+
+
+def _fake_caption(title, digest_only, settings):
+    if digest_only:
+        return {"digest_line_ne": f"{title} सम्बन्धी समाचार।"}
+    return {
+        "headline_ne": f"{title}",
+        "caption_ne": f"{title} सम्बन्धी विस्तृत समाचार। थप विवरण आउँदै छ।",
+        "digest_line_ne": f"{title} सम्बन्धी समाचार।",
+        "significant": settings.rng.random() < settings.significant,
+        "hashtags": ["नेपाल", "समाचार", "TrendingToday"],
+    }
+
+
+def fake_reply(prompt, settings):
+    """The JSON text a well-behaved model would return for `prompt`."""
+    digest_only = '"headline_ne"' not in prompt
+    items = _ITEM_RE.findall(prompt)
+    if items:
+        body = {"items": [dict(_fake_caption(t, digest_only, settings), id=i) for i, t in items]}
+    else:
+        match = _TITLE_RE.search(prompt)
+        body = _fake_caption(match.group(1) if match else "समाचार", digest_only, settings)
+    return json.dumps(body, ensure_ascii=False)
+
+
+def _damage(text, settings, roll):
+    if roll < settings.truncated:
+        return text[: max(1, int(len(text) * 0.7))]
+    if roll < settings.truncated + settings.malformed:
+        text = text.replace("}", ",}", 1).replace('"', "“", 2).replace("“", '"', 1)
+        return f"Here is the JSON you asked for:\n```json\n{text}\n```"
+    return text
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body):
+        data = json.dumps(body, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _error(self, status, gemini):
+        messages = {
+            429: ("RESOURCE_EXHAUSTED", "Resource has been exhausted (e.g. check quota).", "rate_limit_exceeded"),
+            500: ("INTERNAL", "An internal error has occurred.", "internal_server_error"),
+            404: ("NOT_FOUND", "models/unknown is not found for API version v1beta.", "model_not_found"),
+        }
+        status_name, message, code = messages[status]
+        if gemini:
+            body = {"error": {"code": status, "message": message, "status": status_name}}
+        else:
+            body = {"error": {"message": message, "type": "invalid_request_error", "code": code}}
+        self._send(status, body)
+
+    def do_GET(self):
+        path = self.path.split("?")[0]
+        if path.startswith("/v1beta/models/"):
+            name = path.rsplit("/", 1)[-1]
+            self._send(200, {"name": f"models/{name}", "displayName": name})
+        elif path == "/openai/v1/models":
+            self._send(200, {"object": "list", "data": []})
+        else:
+            self._send(404, {"error": {"message": "not found"}})
+
+    def do_POST(self):
+        settings = self.server.settings
+        length = int(self.headers.get("Content-Length") or 0)
+        request = json.loads(self.rfile.read(length) or b"{}")
+        path = self.path.split("?")[0]
+        gemini_match = _GEMINI_RE.match(path)
+        if gemini_match:
+            model = gemini_match.group(1)
+            prompt = "".join(
+                part.get("text", "")
+                for content in request.get("contents", [])
+                for part in content.get("parts", [])
+            )
+        elif path == "/openai/v1/chat/completions":
+            model = request.get("model", "")
+            prompt = "".join(m.get("content") or "" for m in request.get("messages", []))
+        else:
+            self._send(404, {"error": {"message": "not found"}})
+            return
+
+        error_roll, damage_roll, latency_factor = settings.roll()
+        time.sleep(settings.latency_ms / 1000 * latency_factor)
+        gemini = gemini_match is not None
+        if model in settings.dead_models:
+            self._error(404, gemini)
+            return
+        if error_roll < settings.rate_429:
+            self._error(429, gemini)
+            return
+        if error_roll < settings.rate_429 + settings.rate_500:
+            self._error(500, gemini)
+            return
+
+        text = _damage(fake_reply(prompt, settings), settings, damage_roll)
+        if gemini:
+            self._send(200, {
+                "candidates": [{"content": {"parts": [{"text": text}], "role": "model"}, "finishReason": "STOP"}],
+                "modelVersion": model,
+            })
+        else:
+            self._send(200, {
+                "id": "mock", "object": "chat.completion", "created": int(time.time()), "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+                "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+            })
+
+
+def start(settings, host="127.0.0.1", port=0):
+    """Serve in a background thread; returns (server, base_url)."""
+    server = ThreadingHTTPServer((host, port), _Handler)
+    server.daemon_threads = True
+    server.settings = settings
+    threading.Thread(target=server.serve_forever, name="mock-llm", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}"
+
+
+def add_arguments(parser):
+    parser.add_argument("--latency-ms", type=float, default=600, help="median request latency")
+    parser.add_argument("--jitter", type=float, default=0.5, help="lognormal sigma of the latency")
+    parser.add_argument("--rate-429", type=float, default=0.0, help="share of requests answered 429")
+    parser.add_argument("--rate-500", type=float, default=0.0, help="share of requests answered 500")
+    parser.add_argument("--malformed", type=float, default=0.0, help="share of replies with repairable JSON defects")
+    parser.add_argument("--truncated", type=float, default=0.0, help="share of replies cut off part-way")
+    parser.add_argument("--dead-models", default="", help="comma-separated model names that answer 404")
+    parser.add_argument("--seed", type=int, default=1)
+
+
+def settings_from_args(args):
+    return MockSettings(
+        latency_ms=args.latency_ms, jitter=args.jitter, rate_429=args.rate_429, rate_500=args.rate_500,
+        malformed=args.malformed, truncated=args.truncated,
+        dead_models=[m for m in args.dead_models.split(",") if m], seed=args.seed,
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8765)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server, url = start(settings_from_args(args), args.host, args.port)
+    print(f"[mock-llm] Serving Gemini + Groq stand-ins on {url} (Ctrl-C to stop)")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
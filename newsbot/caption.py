@@ -1,9 +1,24 @@
-import json
+import html
 import re
+import time
+from concurrent.futures import ThreadPoolExecutor
 
-from . import config
+from . import config, json_repair, ratelimit
+from .caption_cache import get_cache
+from .llm_clients import get_client, prewarm
+from .provider_health import get_board
 
-PROMPT_TEMPLATE = """You are the news editor for a Nepali Facebook/Instagram page called "Trending Today" (covers Nepal politics/sports, general Nepal news, international news, technology, viral/trending stories, and fact-checks that debunk fake news/misinformation).
+_EDITOR_INTRO = """You are the news editor for a Nepali Facebook/Instagram page called "Trending Today" (covers Nepal politics/sports, general Nepal news, international news, technology, viral/trending stories, and fact-checks that debunk fake news/misinformation)."""
+
+_SIGNIFICANCE_RULES = """Mark significant=true ONLY if it is major breaking news, an important government/political decision, a major sports result or upset, a notable technology launch or development, a genuinely viral/trending story, or an important fact-check that debunks real misinformation. Mark significant=false for routine, minor, or low-interest news -- most stories should be false; be selective, we only want the best few stories of the day as card posts."""
+
+_CAPTION_FIELDS = """  "headline_ne": "a short Nepali headline in Devanagari script, faithful to the original title above, max 12 words, no hashtags, no emoji",
+  "caption_ne": "a factual Nepali news summary in Devanagari script, 2 to 3 sentences (never more than 3), longer and more detailed than the headline",
+  "digest_line_ne": "the same story compressed into just 1 sentence (max 2 short sentences) of Devanagari Nepali, for a bullet point in an end-of-day round-up post",
+  "significant": true or false (boolean, see criteria above),
+  "hashtags": ["3 to 5 relevant hashtags without the # symbol"]"""
+
+PROMPT_TEMPLATE = _EDITOR_INTRO + """
 
 Rewrite the following news item as an ORIGINAL short news post written in the NEPALI language (Devanagari script). Do not translate word-for-word -- write it naturally, the way a Nepali news page would: factual, neutral, no clickbait, no emoji spam.
 
@@ -15,74 +30,498 @@ Original title: {title}
 Original summary: {summary}
 Link: {link}
 
-Also judge whether this story is SIGNIFICANT enough to deserve its own big graphic card post (not just a line in the end-of-day round-up). Mark significant=true ONLY if it is major breaking news, an important government/political decision, a major sports result or upset, a notable technology launch or development, a genuinely viral/trending story, or an important fact-check that debunks real misinformation. Mark significant=false for routine, minor, or low-interest news -- most stories should be false; be selective, we only want the best few stories of the day as card posts.
+Also judge whether this story is SIGNIFICANT enough to deserve its own big graphic card post (not just a line in the end-of-day round-up). """ + _SIGNIFICANCE_RULES + """
 
 Return ONLY a JSON object with these exact keys, and nothing else:
 {{
-  "headline_ne": "a short Nepali headline in Devanagari script, faithful to the original title above, max 12 words, no hashtags, no emoji",
-  "caption_ne": "a factual Nepali news summary in Devanagari script, 2 to 3 sentences (never more than 3), longer and more detailed than the headline",
-  "digest_line_ne": "the same story compressed into just 1 sentence (max 2 short sentences) of Devanagari Nepali, for a bullet point in an end-of-day round-up post",
-  "significant": true or false (boolean, see criteria above),
-  "hashtags": ["3 to 5 relevant hashtags without the # symbol"]
+""" + _CAPTION_FIELDS + """
 }}
 """
 
+# Several stories in one request: the fixed instructions are sent once, and
+# each story is tagged with a short id the model must echo back.
+BATCH_PROMPT_TEMPLATE = _EDITOR_INTRO + """
+
+Rewrite EACH of the {count} news items below as a separate ORIGINAL short news post written in the NEPALI language (Devanagari script). Do not translate word-for-word -- write it naturally, the way a Nepali news page would: factual, neutral, no clickbait, no emoji spam. Treat every item independently; never mix facts between items.
+
+Each headline must stay faithful to that item's ORIGINAL TITLE -- adapt it into natural Nepali, but do not invent a different angle or add facts that aren't in the source.
+
+{stories}
+
+Also judge, for each item separately, whether it is SIGNIFICANT enough to deserve its own big graphic card post (not just a line in the end-of-day round-up). """ + _SIGNIFICANCE_RULES + """
+
+Return ONLY a JSON object with a single "items" key holding an array with exactly one object per item, and nothing else. Each object has an "id" key holding the item's id exactly as given, plus these exact keys:
+{{"items": [
+  {{
+  "id": "the item id",
+""" + _CAPTION_FIELDS + """
+  }}
+]}}
+"""
+
+BATCH_STORY_TEMPLATE = """--- Item id: {id}
+Category hint from our own classifier: {category}
+Source: {source}
+Original title: {title}
+Original summary: {summary}
+Link: {link}"""
+
+# Stories the local pre-scoring (significance.py) expects to be routine only
+# ever appear as a digest bullet, so they get this much shorter request.
+_DIGEST_FIELDS = (
+    '  "digest_line_ne": "the story in just 1 sentence (max 2 short sentences) of Devanagari Nepali, '
+    'for a bullet point in an end-of-day round-up post"'
+)
+
+DIGEST_PROMPT_TEMPLATE = _EDITOR_INTRO + """
+
+Summarise the following news item for a bullet point in our end-of-day round-up post, written in the NEPALI language (Devanagari script): factual, neutral, natural Nepali, not a word-for-word translation, and no facts that aren't in the source.
+
+Category hint from our own classifier: {category}
+Source: {source}
+Original title: {title}
+Original summary: {summary}
+Link: {link}
+
+Return ONLY a JSON object with this exact key, and nothing else:
+{{
+""" + _DIGEST_FIELDS + """
+}}
+"""
+
+DIGEST_BATCH_PROMPT_TEMPLATE = _EDITOR_INTRO + """
+
+Summarise EACH of the {count} news items below for a bullet point in our end-of-day round-up post, written in the NEPALI language (Devanagari script): factual, neutral, natural Nepali, not a word-for-word translation, and no facts that aren't in the source. Treat every item independently; never mix facts between items.
+
+{stories}
+
+Return ONLY a JSON object with a single "items" key holding an array with exactly one object per item, and nothing else. Each object has an "id" key holding the item's id exactly as given, plus this exact key:
+{{"items": [
+  {{
+  "id": "the item id",
+""" + _DIGEST_FIELDS + """
+  }}
+]}}
+"""
+
+# Per prompt mode: single-story template, batch template, the keys a reply
+# must fill in (all of them: a reply cut off between fields is re-requested,
+# not cached with a made-up significant=False), and roughly what one story's
+# reply costs in tokens (for the tokens-per-minute limits).
+PROMPT_MODES = {
+    "full": (
+        PROMPT_TEMPLATE, BATCH_PROMPT_TEMPLATE,
+        ("headline_ne", "caption_ne", "digest_line_ne", "significant", "hashtags"), 400,
+    ),
+    "digest": (DIGEST_PROMPT_TEMPLATE, DIGEST_BATCH_PROMPT_TEMPLATE, ("digest_line_ne",), 80),
+}
+
+
+_FIELD_SCHEMAS = {
+    "headline_ne": {"type": "string"},
+    "caption_ne": {"type": "string"},
+    "digest_line_ne": {"type": "string"},
+    "significant": {"type": "boolean"},
+    "hashtags": {"type": "array", "items": {"type": "string"}},
+}
+
+
+def response_schema(mode="full", batch=False):
+    """JSON schema of a reply, for providers with native structured output."""
+    fields = PROMPT_MODES[mode][2] + (("id",) if batch else ())
+    story = {
+        "type": "object",
+        "properties": {f: _FIELD_SCHEMAS.get(f, {"type": "string"}) for f in fields},
+        "required": list(fields),
+    }
+    if not batch:
+        return story
+    return {
+        "type": "object",
+        "properties": {"items": {"type": "array", "items": story}},
+        "required": ["items"],
+    }
+
 
 def _extract_json(text):
-    match = re.search(r"\{.*\}", text, re.DOTALL)
-    if not match:
+    data = json_repair.loads(text)
+    if not isinstance(data, dict):
         raise ValueError(f"No JSON object found in model output: {text[:200]!r}")
-    return json.loads(match.group(0))
+    return data
 
 
-def _call_gemini(prompt, api_key, model):
-    from google import genai
+def _call_gemini(prompt, api_key, model, schema=None):
+    client = get_client("gemini", api_key)
+    kwargs = {}
+    if schema is not None:
+        from google.genai import types
 
-    client = genai.Client(api_key=api_key)
-    resp = client.models.generate_content(model=model, contents=prompt)
+        kwargs["config"] = types.GenerateContentConfig(
+            response_mime_type="application/json", response_json_schema=schema
+        )
+    resp = client.models.generate_content(model=model, contents=prompt, **kwargs)
     return resp.text
 
 
-def _call_groq(prompt, api_key, model):
-    from groq import Groq
-
-    client = Groq(api_key=api_key)
+def _call_groq(prompt, api_key, model, schema=None):
+    client = get_client("groq", api_key)
+    kwargs = {}
+    if schema is not None:
+        # JSON mode: guarantees well-formed JSON; the shape comes from the
+        # prompt and is checked by _coerce_caption.
+        kwargs["response_format"] = {"type": "json_object"}
     resp = client.chat.completions.create(
         model=model,
         messages=[{"role": "user", "content": prompt}],
+        **kwargs,
     )
     return resp.choices[0].message.content
 
 
-def write_caption(item):
-    prompt = PROMPT_TEMPLATE.format(
-        category=item.get("category") or "general",
-        source=item.get("source"),
-        title=item.get("title"),
-        summary=item.get("summary") or "(no summary provided)",
-        link=item.get("link"),
+def _extract_json_array(text):
+    """Batch replies: {"items": [...]}, a bare array, or (some models do
+    this) an object mapping id -> object."""
+    data = json_repair.loads(text)
+    if isinstance(data, dict) and isinstance(data.get("items"), list):
+        return data["items"]
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict) and all(isinstance(v, dict) for v in data.values()):
+        return [dict(v, id=k) for k, v in data.items()]
+    raise ValueError(f"No JSON array found in model output: {text[:200]!r}")
+
+
+_TRUE_WORDS = ("true", "yes", "1", "y")
+_FALSE_WORDS = ("false", "no", "0", "n")
+
+
+def _coerce_caption(result, mode="full"):
+    """Normalise one story's reply to the schema, or return None if any of
+    the mode's fields is missing, empty or unreadable. "significant" becomes
+    a real bool (models send "true", "yes", 1, ...) and hashtags a clean
+    list."""
+    if not isinstance(result, dict):
+        return None
+    out = {}
+    for key, value in result.items():
+        out[key] = value.strip() if isinstance(value, str) else value
+    for key in PROMPT_MODES[mode][2]:
+        kind = _FIELD_SCHEMAS[key]["type"]
+        if kind == "string" and not (isinstance(out.get(key), str) and out[key]):
+            return None
+        if kind != "string" and out.get(key) is None:
+            return None
+    if "significant" in out:
+        value = out["significant"]
+        if isinstance(value, str):
+            value = value.lower()
+            if value not in _TRUE_WORDS + _FALSE_WORDS:
+                return None
+            value = value in _TRUE_WORDS
+        elif not isinstance(value, (bool, int)):
+            return None
+        out["significant"] = bool(value)
+    if "hashtags" in out:
+        tags = out["hashtags"]
+        if isinstance(tags, str):
+            tags = re.split(r"[,\s]+", tags)
+        if not isinstance(tags, list):
+            return None
+        out["hashtags"] = [str(t).strip().lstrip("#") for t in tags if str(t).strip().lstrip("#")]
+    return out
+
+
+def _parse_caption(mode):
+    def parse(text):
+        result = _coerce_caption(_extract_json(text), mode)
+        if result is None:
+            raise ValueError(f"Reply is missing required fields: {text[:200]!r}")
+        return result
+    return parse
+
+
+def estimate_tokens(text):
+    """Rough token count for budgeting: Devanagari tokenises at roughly one
+    token per 2-3 characters on these models, so err on the high side."""
+    return len(text) // 3 + 1
+
+
+_DROP_BLOCKS_RE = re.compile(r"<(script|style|figure|figcaption|noscript|iframe)\b.*?</\1\s*>", re.DOTALL | re.IGNORECASE)
+_BREAK_TAGS_RE = re.compile(r"<\s*(br|/p|/div|/li|/h[1-6])\b[^>]*>", re.IGNORECASE)
+_TAG_RE = re.compile(r"<[^>]+>")
+# Feed boilerplate that says nothing about the story.
+_BOILERPLATE_RES = [
+    re.compile(p, re.IGNORECASE)
+    for p in (
+        r"The post .{0,300}? appeared first on .{0,120}?\.",
+        r"(Continue|Keep) reading.{0,80}$",
+        r"Read (the )?(full|more)( story| article)?.{0,40}$",
+        r"\[(…|\.\.\.|&hellip;)\]",
+        r"Click here to .{0,80}$",
+        r"(Follow|Subscribe to) us on .{0,80}$",
+        r"थप पढ्नुहोस्.{0,40}$",
     )
+]
+_SENTENCE_END_RE = re.compile(r"(?<=[.!?।])\s+")
+
+
+def compact_summary(summary, budget_tokens=None):
+    """Feed summary -> plain prompt text: HTML, images and feed boilerplate
+    stripped, whitespace collapsed, then cut at a sentence boundary to about
+    `budget_tokens` (SUMMARY_TOKEN_BUDGET; 0 means no limit)."""
+    budget = config.SUMMARY_TOKEN_BUDGET if budget_tokens is None else budget_tokens
+    text = _DROP_BLOCKS_RE.sub(" ", summary or "")
+    text = _BREAK_TAGS_RE.sub(" ", text)
+    text = html.unescape(_TAG_RE.sub(" ", text))
+    text = " ".join(text.split())
+    for pattern in _BOILERPLATE_RES:
+        text = pattern.sub("", text).strip()
+    if not budget or estimate_tokens(text) <= budget:
+        return text
+
+    kept = []
+    for sentence in _SENTENCE_END_RE.split(text):
+        if estimate_tokens(" ".join(kept + [sentence])) > budget:
+            break
+        kept.append(sentence)
+    if kept:
+        return " ".join(kept)
+    # Not even the first sentence fits: keep as many whole words as do.
+    words = []
+    for word in text.split():
+        if estimate_tokens(" ".join(words + [word])) > budget:
+            break
+        words.append(word)
+    return " ".join(words) + "…"
+
+
+def _story_fields(item):
+    return {
+        "category": item.get("category") or "general",
+        "source": item.get("source"),
+        "title": item.get("title"),
+        "summary": compact_summary(item.get("summary")) or "(no summary provided)",
+        "link": item.get("link"),
+    }
+
+
+def build_prompt(item, mode="full"):
+    return PROMPT_MODES[mode][0].format(**_story_fields(item))
+
+
+def _model_ids():
+    return [f"gemini:{m}" for m in config.GEMINI_MODELS] + [f"groq:{m}" for m in config.GROQ_MODELS]
+
+
+_PROVIDER_NAMES = {"gemini": "Gemini", "groq": "Groq"}
+_CALLERS = {"gemini": lambda *args: _call_gemini(*args), "groq": lambda *args: _call_groq(*args)}
+
 
+def _attempts():
+    # The chain is every configured Gemini key against the primary model,
+    # then every key against the fallback model, then the same for Groq, so
+    # neither a single rate-limited/expired key NOR a single retired model
+    # name can stop the whole run. The health board (see _generate) skips
+    # keys/models that recently hit quota or "model not found" errors and
+    # tries the healthiest, fastest key of each model first.
+    return [
+        ("gemini", model, i, key)
+        for model in config.GEMINI_MODELS
+        for i, key in enumerate(config.GEMINI_API_KEYS, start=1)
+    ] + [
+        ("groq", model, i, key)
+        for model in config.GROQ_MODELS
+        for i, key in enumerate(config.GROQ_API_KEYS, start=1)
+    ]
+
+
+def prewarm_clients():
+    """Start connecting to the providers the next caption call will use."""
+    return prewarm(get_board().order(_attempts()))
+
+
+def _generate(prompt, parse, reply_tokens=PROMPT_MODES["full"][3], schema=None):
+    """Run `prompt` through the provider chain and return (model_id,
+    parse(reply)) from the first key/model that gives a parseable reply.
+    `reply_tokens` sizes the reply for the tokens-per-minute limits, and
+    `schema` (with STRUCTURED_OUTPUT on) asks for native JSON output."""
+    if not config.STRUCTURED_OUTPUT:
+        schema = None
     last_err = None
+    cost = estimate_tokens(prompt) + reply_tokens
 
-    # Try every configured Gemini key against the primary model first, then
-    # every key against the fallback model, then do the same for Groq. This
-    # way neither a single rate-limited/expired key NOR a single retired
-    # model name can stop the whole run.
-    for model in config.GEMINI_MODELS:
-        for i, key in enumerate(config.GEMINI_API_KEYS, start=1):
-            try:
-                return _extract_json(_call_gemini(prompt, key, model))
-            except Exception as exc:  # noqa: BLE001
-                last_err = exc
-                print(f"[caption] Gemini {model} key #{i} failed, trying next: {exc}")
-
-    for model in config.GROQ_MODELS:
-        for i, key in enumerate(config.GROQ_API_KEYS, start=1):
-            try:
-                return _extract_json(_call_groq(prompt, key, model))
-            except Exception as exc:  # noqa: BLE001
-                last_err = exc
-                print(f"[caption] Groq {model} key #{i} failed, trying next: {exc}")
+    board = get_board()
+    for n, (provider, model, i, key) in enumerate(board.order(_attempts())):
+        name = _PROVIDER_NAMES[provider]
+        if n and board.is_open(provider, model, key):
+            # Opened by an earlier attempt in this loop, e.g. a "model not
+            # found" on another key for the same model.
+            continue
+        if not ratelimit.acquire(provider, i, cost):
+            last_err = RuntimeError(f"{name} key #{i} is rate-limited")
+            print(f"[caption] {name} {model} key #{i} is at its rate limit, trying next")
+            continue
+        started = time.monotonic()
+        try:
+            reply = _CALLERS[provider](prompt, key, model, schema)
+        except Exception as exc:  # noqa: BLE001
+            board.record_failure(provider, model, key, exc, time.monotonic() - started)
+            last_err = exc
+            print(f"[caption] {name} {model} key #{i} failed, trying next: {exc}")
+            continue
+        board.record_success(provider, model, key, time.monotonic() - started)
+        try:
+            return f"{provider}:{model}", parse(reply)
+        except Exception as exc:  # noqa: BLE001
+            last_err = exc
+            print(f"[caption] {name} {model} key #{i} gave an unusable reply, trying next: {exc}")
 
     raise RuntimeError(f"All caption providers/keys/models failed: {last_err}")
+
+
+def _caption_uncached(prompt, mode="full"):
+    model_id, result = _generate(
+        prompt, _parse_caption(mode), PROMPT_MODES[mode][3], response_schema(mode)
+    )
+    get_cache().put(prompt, model_id, result)
+    return result
+
+
+def write_caption(item):
+    prompt = build_prompt(item)
+
+    # A story already captioned by any model in the chain (e.g. by a run
+    # that crashed before saving the history) costs no provider calls.
+    cached_model, cached = get_cache().get(prompt, _model_ids())
+    # Entries cached before every field was required may be incomplete.
+    cached = _coerce_caption(cached)
+    if cached is not None:
+        print(f"[caption] Cache hit ({cached_model})")
+        return cached
+    return _caption_uncached(prompt)
+
+
+def _plan_batches(entries, mode):
+    """Split the (index, item, prompt, story) entries for one prompt mode
+    into batches of at most CAPTION_BATCH_SIZE stories and
+    CAPTION_BATCH_TOKEN_BUDGET estimated prompt tokens. A story too big for
+    the budget on its own gets a batch to itself."""
+    overhead = estimate_tokens(PROMPT_MODES[mode][1])
+    batches, current, used = [], [], overhead
+    for entry in entries:
+        cost = estimate_tokens(entry[3])
+        if current and (
+            len(current) >= config.CAPTION_BATCH_SIZE
+            or used + cost > config.CAPTION_BATCH_TOKEN_BUDGET
+        ):
+            batches.append(current)
+            current, used = [], overhead
+        current.append(entry)
+        used += cost
+    if current:
+        batches.append(current)
+    return batches
+
+
+def write_captions(items, modes=None):
+    """Caption several stories with as few requests as possible.
+
+    `modes` gives each item's prompt mode: "full" (the default; headline,
+    caption, digest line, significance, hashtags) or "digest" (the digest
+    line only, for stories that will never get a card; their result comes
+    back with significant=False).
+
+    Returns one entry per item, in order: the caption dict, or the exception
+    that stopped that story from being captioned. Cached stories are served
+    from the cache; the rest go out in batches (see _plan_batches), and any
+    story a batch reply leaves out or gets wrong is re-requested on its own
+    with the single-story prompt.
+    """
+    cache = get_cache()
+    modes = modes or ["full"] * len(items)
+    results = [None] * len(items)
+    entries = {mode: [] for mode in PROMPT_MODES}
+    for index, (item, mode) in enumerate(zip(items, modes)):
+        prompt = build_prompt(item, mode)
+        cached_model, cached = cache.get(prompt, _model_ids())
+        cached = _coerce_caption(cached, mode)
+        if cached is not None:
+            print(f"[caption] Cache hit ({cached_model})")
+            results[index] = cached
+            continue
+        story = BATCH_STORY_TEMPLATE.format(id=str(index), **_story_fields(item))
+        entries[mode].append((index, item, prompt, story))
+
+    pending = [estimate_tokens(entry[2]) for mode_entries in entries.values() for entry in mode_entries]
+    if pending:
+        print(
+            f"[caption] {len(pending)} story prompt(s) to send: ~{sum(pending) // len(pending)} tokens "
+            f"each on average, {max(pending)} at most"
+        )
+
+    def run_batch(job):
+        # Fills in `results` for the stories the reply got right and returns
+        # the entries that still need a request of their own.
+        mode, batch = job
+        batch_prompt = PROMPT_MODES[mode][1].format(
+            count=len(batch), stories="\n\n".join(entry[3] for entry in batch)
+        )
+        try:
+            model_id, replies = _generate(
+                batch_prompt, _extract_json_array, len(batch) * PROMPT_MODES[mode][3],
+                response_schema(mode, batch=True),
+            )
+        except Exception as exc:  # noqa: BLE001
+            print(f"[caption] Batch of {len(batch)} failed, captioning one by one: {exc}")
+            return [(mode, entry) for entry in batch]
+        by_id = {
+            str(reply.get("id")): reply
+            for reply in replies
+            if isinstance(reply, dict)
+        }
+        missing = []
+        for entry in batch:
+            index, _, prompt, _ = entry
+            reply = _coerce_caption(by_id.get(str(index)), mode)
+            if reply is None:
+                missing.append((mode, entry))
+                continue
+            reply.pop("id", None)
+            cache.put(prompt, model_id, reply)
+            results[index] = reply
+        print(
+            f"[caption] Batch of {len(batch)} ({mode}, ~{estimate_tokens(batch_prompt)} prompt tokens) via {model_id}: "
+            f"{len(batch) - len(missing)} ok, {len(missing)} to retry one by one"
+        )
+        return missing
+
+    def run_single(job):
+        mode, (index, _, prompt, _) = job
+        try:
+            results[index] = _caption_uncached(prompt, mode)
+        except Exception as exc:  # noqa: BLE001
+            results[index] = exc
+
+    batches, retry = [], []
+    for mode, mode_entries in entries.items():
+        if config.CAPTION_BATCH_SIZE <= 1:
+            retry.extend((mode, entry) for entry in mode_entries)
+            continue
+        for batch in _plan_batches(mode_entries, mode):
+            if len(batch) == 1:
+                retry.append((mode, batch[0]))
+            else:
+                batches.append((mode, batch))
+
+    # Requests run concurrently; ratelimit keeps each key under its RPM/TPM.
+    # Results land in `results` by index, so the order they arrive in never
+    # matters to the caller.
+    workers = max(1, config.CAPTION_WORKERS)
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        for missing in pool.map(run_batch, batches):
+            retry.extend(missing)
+        list(pool.map(run_single, retry))
+    for result, mode in zip(results, modes):
+        if mode == "digest" and isinstance(result, dict):
+            result.setdefault("significant", False)
+    return results
@@ -0,0 +1,157 @@
+"""Persistent cache of LLM caption results.
+
+Every model call for a story is keyed by sha256(provider:model + the fully
+rendered prompt), so the same story sent to the same model is only ever paid
+for once -- across a crashed prepare, a workflow_dispatch retry, or a local
+test run. The file is not committed: the workflow carries it from run to run
+with actions/cache, saved even when prepare fails.
+
+The file holds one JSON entry per line. put() appends just the new entry, so
+a result is on disk the moment it is paid for, at the cost of one line; a
+later line for the same key wins, and a line cut off by a crash is skipped on
+load. flush() at the end of prepare rewrites the file compacted: entries
+expire after CAPTION_CACHE_TTL_HOURS and only the CAPTION_CACHE_MAX_ENTRIES
+most recently used are kept, oldest first. CAPTION_CACHE_TTL_HOURS=0 turns
+the cache off.
+"""
+
+import hashlib
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from . import config
+
+
+def cache_key(model_id, prompt):
+    return hashlib.sha256(f"{model_id}\n{prompt}".encode("utf-8")).hexdigest()
+
+
+class CaptionCache:
+    def __init__(self, path, ttl_seconds, max_entries):
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self._entries = None
+        self._dirty = False
+        self._needs_newline = False
+        # write_captions() calls in from several threads at once.
+        self._lock = threading.RLock()
+
+    @property
+    def enabled(self):
+        return self.ttl_seconds > 0 and self.max_entries > 0
+
+    def _load(self):
+        if self._entries is not None:
+            return self._entries
+        self._entries = OrderedDict()
+        if not os.path.exists(self.path):
+            return self._entries
+        skipped = 0
+        try:
+            with open(self.path, "r", encoding="utf-8") as f:
+                for line in f:
+                    self._needs_newline = not line.endswith("\n")
+                    try:
+                        entry = json.loads(line)
+                        key = entry.pop("key")
+                    except (json.JSONDecodeError, AttributeError, KeyError):
+                        skipped += 1
+                        continue
+                    self._entries[key] = entry
+                    self._entries.move_to_end(key)
+        except OSError as exc:
+            print(f"[caption-cache] Ignoring unreadable {self.path}: {exc}")
+        if skipped:
+            print(f"[caption-cache] Skipped {skipped} unreadable line(s) in {self.path}")
+            self._dirty = True
+        return self._entries
+
+    def get(self, prompt, model_ids):
+        """Return (model_id, result) for the first of `model_ids` with a live
+        cached result for `prompt`, else (None, None)."""
+        if not self.enabled:
+            return None, None
+        with self._lock:
+            entries = self._load()
+            now = time.time()
+            for model_id in model_ids:
+                key = cache_key(model_id, prompt)
+                entry = entries.get(key)
+                if entry is None:
+                    continue
+                if now - entry.get("created", 0) > self.ttl_seconds:
+                    del entries[key]
+                    self._dirty = True
+                    continue
+                entries.move_to_end(key)
+                self._dirty = True
+                self.hits += 1
+                return model_id, entry["result"]
+            self.misses += 1
+            return None, None
+
+    def put(self, prompt, model_id, result):
+        """Store a result and append it to the file straight away, so a crash
+        later in the run doesn't lose calls that were already paid for."""
+        if not self.enabled:
+            return
+        with self._lock:
+            entries = self._load()
+            key = cache_key(model_id, prompt)
+            entry = {"model": model_id, "created": time.time(), "result": result}
+            entries[key] = entry
+            entries.move_to_end(key)
+            while len(entries) > self.max_entries:
+                entries.popitem(last=False)
+            self._dirty = True
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            with open(self.path, "a", encoding="utf-8") as f:
+                if self._needs_newline:
+                    # The last run died mid-line; don't glue onto it.
+                    f.write("\n")
+                    self._needs_newline = False
+                f.write(json.dumps(dict(entry, key=key), ensure_ascii=False) + "\n")
+
+    def flush(self):
+        """Rewrite the file with just the live entries, in LRU order."""
+        with self._lock:
+            if not self._dirty or self._entries is None:
+                return
+            now = time.time()
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                for key, entry in list(self._entries.items()):
+                    if now - entry.get("created", 0) > self.ttl_seconds:
+                        del self._entries[key]
+                        continue
+                    f.write(json.dumps(dict(entry, key=key), ensure_ascii=False) + "\n")
+            os.replace(tmp_path, self.path)
+            self._dirty = False
+            self._needs_newline = False
+
+    def stats(self):
+        size = len(self._entries) if self._entries is not None else 0
+        return {"hits": self.hits, "misses": self.misses, "entries": size}
+
+
+_cache = None
+
+
+def get_cache():
+    global _cache
+    if _cache is None:
+        _cache = CaptionCache(
+            config.CAPTION_CACHE_FILE,
+            config.CAPTION_CACHE_TTL_HOURS * 3600,
+            config.CAPTION_CACHE_MAX_ENTRIES,
+        )
+    return _cache
@@ -1,7 +1,15 @@
+import hashlib
+import io
+import multiprocessing
 import os
+import time
+from concurrent.futures import Future, ProcessPoolExecutor
+from functools import lru_cache
 
 from PIL import Image, ImageDraw, ImageFont
 
+from . import config
+
 WIDTH, HEIGHT = 1080, 1080
 
 ASSETS_DIR = os.path.join(os.path.dirname(__file__), "assets")
@@ -17,6 +25,9 @@ SUBTITLE_COLOR = (55, 55, 55)
 TITLE_TOP, TITLE_BOTTOM = 40, 300
 SUBTITLE_TOP, SUBTITLE_BOTTOM = 650, 1010
 TEXT_MAX_WIDTH = WIDTH - 140
+# (start, min) font size of each block; _fit_block steps down by 4.
+TITLE_SIZES = (76, 48)
+SUBTITLE_SIZES = (40, 26)
 
 # fonts-noto-core (installed by the workflow via apt) ships Devanagari-capable
 # Noto Sans fonts at these paths on Ubuntu runners.
@@ -32,74 +43,284 @@ FONT_REGULAR_CANDIDATES = [
 ]
 
 
-def _load_font(candidates, size):
+# Rendering context shared by every card in the process: the font file each
+# candidate list resolves to, the FreeType fonts by (path, size) -- _fit_block
+# tries several sizes per block -- and the decoded template.
+FONT_CACHE_SIZE = 64
+
+
+@lru_cache(maxsize=None)
+def _font_path(candidates):
     for path in candidates:
         if os.path.exists(path):
-            return ImageFont.truetype(path, size)
-    return ImageFont.load_default()
+            return path
+    return None
+
+
+@lru_cache(maxsize=FONT_CACHE_SIZE)
+def _truetype(path, size):
+    return ImageFont.truetype(path, size)
+
+
+def _load_font(candidates, size):
+    path = _font_path(tuple(candidates))
+    if path is None:
+        return ImageFont.load_default()
+    return _truetype(path, size)
+
+
+@lru_cache(maxsize=1)
+def _template(path):
+    base = Image.open(path).convert("RGB")
+    if base.size != (WIDTH, HEIGHT):
+        base = base.resize((WIDTH, HEIGHT))
+    return base
+
+
+# Widths of words, spaces and whole lines, per font. Fonts come from the
+# cache above, so the same object is handed out for a given (path, size).
+WIDTH_CACHE_SIZE = 8192
+_MEASURE = ImageDraw.Draw(Image.new("RGB", (1, 1)))
+
+
+@lru_cache(maxsize=WIDTH_CACHE_SIZE)
+def _text_width(font, text):
+    return _MEASURE.textlength(text, font=font)
 
 
 def _wrap_text(draw, text, font, max_width):
+    """Greedy word wrap. Each word is measured once per font and a line's
+    width is the sum of its words and spaces; only when that sum lands within
+    half an em of max_width -- where kerning or shaping across the joins
+    could tip it either way -- is the joined line measured exactly, so the
+    breaks are the same as measuring every trial line."""
     words = text.split()
-    lines, current = [], ""
+    space = _text_width(font, " ")
+    slack = getattr(font, "size", 10) * 0.5
+    lines, current, current_w = [], "", 0.0
     for word in words:
-        trial = f"{current} {word}".strip()
-        if draw.textlength(trial, font=font) <= max_width:
-            current = trial
+        word_w = _text_width(font, word)
+        if not current:
+            current, current_w = word, word_w
+            continue
+        trial_w = current_w + space + word_w
+        if max_width - slack < trial_w <= max_width + slack:
+            trial_w = _text_width(font, f"{current} {word}")
+        if trial_w <= max_width:
+            current, current_w = f"{current} {word}", trial_w
         else:
-            if current:
-                lines.append(current)
-            current = word
+            lines.append(current)
+            current, current_w = word, word_w
     if current:
         lines.append(current)
     return lines or [text]
 
 
 def _fit_block(draw, text, max_width, max_height, bold, start_size, min_size, line_gap_ratio=1.3):
-    """Shrink the font size until the wrapped text block fits max_height."""
+    """Largest size from start_size down to min_size, in steps of 4, at which
+    the wrapped text block fits max_height. Most headlines fit at start_size,
+    so that is tried first; otherwise the remaining sizes are binary-searched
+    (a smaller font never needs more lines)."""
     candidates = FONT_BOLD_CANDIDATES if bold else FONT_REGULAR_CANDIDATES
-    size = start_size
-    while size >= min_size:
+
+    def layout(size):
         font = _load_font(candidates, size)
-        lines = _wrap_text(draw, text, font, max_width)
-        line_height = int(size * line_gap_ratio)
-        block_height = line_height * len(lines)
-        if block_height <= max_height:
-            return font, lines, line_height
-        size -= 4
-    font = _load_font(candidates, min_size)
-    lines = _wrap_text(draw, text, font, max_width)
-    return font, lines, int(min_size * line_gap_ratio)
+        return font, _wrap_text(draw, text, font, max_width), int(size * line_gap_ratio)
+
+    def fits(result):
+        return result[2] * len(result[1]) <= max_height
+
+    sizes = list(range(start_size, min_size - 1, -4))
+    if sizes:
+        first = layout(sizes[0])
+        if fits(first):
+            return first
+        found = None
+        lo, hi = 1, len(sizes)
+        while lo < hi:
+            mid = (lo + hi) // 2
+            result = layout(sizes[mid])
+            if fits(result):
+                found, hi = result, mid
+            else:
+                lo = mid + 1
+        if found is not None:
+            return found
+    return layout(min_size)
 
 
 def _draw_centered_block(draw, lines, font, line_height, zone_top, zone_bottom, fill):
     block_height = line_height * len(lines)
     y = zone_top + max(0, (zone_bottom - zone_top - block_height) // 2)
     for line in lines:
-        w = draw.textlength(line, font=font)
+        w = _text_width(font, line)
         draw.text(((WIDTH - w) / 2, y), line, font=font, fill=fill)
         y += line_height
 
 
-def generate_card(headline_ne, subtitle_ne, output_path):
-    base = Image.open(TEMPLATE_PATH).convert("RGB")
-    if base.size != (WIDTH, HEIGHT):
-        base = base.resize((WIDTH, HEIGHT))
-    img = base.copy()
+def render_card(headline_ne, subtitle_ne):
+    img = _template(TEMPLATE_PATH).copy()
     draw = ImageDraw.Draw(img)
 
     title_font, title_lines, title_line_h = _fit_block(
         draw, headline_ne, TEXT_MAX_WIDTH, TITLE_BOTTOM - TITLE_TOP, bold=True,
-        start_size=76, min_size=48,
+        start_size=TITLE_SIZES[0], min_size=TITLE_SIZES[1],
     )
     _draw_centered_block(draw, title_lines, title_font, title_line_h, TITLE_TOP, TITLE_BOTTOM, TITLE_COLOR)
 
     subtitle_font, subtitle_lines, subtitle_line_h = _fit_block(
         draw, subtitle_ne, TEXT_MAX_WIDTH, SUBTITLE_BOTTOM - SUBTITLE_TOP, bold=False,
-        start_size=40, min_size=26,
+        start_size=SUBTITLE_SIZES[0], min_size=SUBTITLE_SIZES[1],
     )
     _draw_centered_block(draw, subtitle_lines, subtitle_font, subtitle_line_h, SUBTITLE_TOP, SUBTITLE_BOTTOM, SUBTITLE_COLOR)
+    return img
+
+
+def card_extension():
+    return ".webp" if config.CARD_FORMAT == "webp" else ".jpg"
 
+
+def _encode(img, fmt, quality):
+    buf = io.BytesIO()
+    if fmt == "webp":
+        img.save(buf, "WEBP", quality=quality, method=6)
+    else:
+        img.save(
+            buf, "JPEG", quality=quality, optimize=True,
+            progressive=config.CARD_PROGRESSIVE, subsampling=config.CARD_SUBSAMPLING,
+        )
+    return buf.getvalue()
+
+
+def encode_card(img, fmt=None, max_bytes=None):
+    """Encode at CARD_QUALITY, or -- if that is over `max_bytes` (default
+    CARD_MAX_BYTES, 0 = no budget) -- at the highest quality down to
+    CARD_MIN_QUALITY that fits, found by binary search. Returns (data,
+    quality); at CARD_MIN_QUALITY the result may still be over budget."""
+    fmt = fmt or config.CARD_FORMAT
+    max_bytes = config.CARD_MAX_BYTES if max_bytes is None else max_bytes
+    data = _encode(img, fmt, config.CARD_QUALITY)
+    if not max_bytes or len(data) <= max_bytes:
+        return data, config.CARD_QUALITY
+    tried = {}
+    lo, hi = config.CARD_MIN_QUALITY, config.CARD_QUALITY - 1
+    while lo <= hi:
+        mid = (lo + hi) // 2
+        tried[mid] = _encode(img, fmt, mid)
+        if len(tried[mid]) <= max_bytes:
+            lo = mid + 1
+        else:
+            hi = mid - 1
+    quality = max(hi, config.CARD_MIN_QUALITY)
+    return tried.get(quality) or _encode(img, fmt, quality), quality
+
+
+def write_card(img, output_path):
+    """Encode `img` (see encode_card) to `output_path`. Returns {"bytes",
+    "sha256", "quality"}."""
+    data, quality = encode_card(img)
     os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    img.save(output_path, "JPEG", quality=92)
+    with open(output_path, "wb") as f:
+        f.write(data)
+    return {"bytes": len(data), "sha256": hashlib.sha256(data).hexdigest(), "quality": quality}
+
+
+def generate_card(headline_ne, subtitle_ne, output_path):
+    write_card(render_card(headline_ne, subtitle_ne), output_path)
     return output_path
+
+
+def _warm_up():
+    """Decode the template and open every font generate_card can pick, so a
+    fresh render worker's first card costs no more than its tenth."""
+    _template(TEMPLATE_PATH)
+    for candidates, (start, min_size) in (
+        (FONT_BOLD_CANDIDATES, TITLE_SIZES),
+        (FONT_REGULAR_CANDIDATES, SUBTITLE_SIZES),
+    ):
+        for size in list(range(start, min_size - 1, -4)) + [min_size]:
+            _load_font(candidates, size)
+
+
+def _render(job):
+    headline_ne, subtitle_ne, output_path = job
+    started = time.perf_counter()
+    result = {"path": output_path, "error": None, "bytes": 0, "sha256": None, "quality": None}
+    try:
+        result.update(write_card(render_card(headline_ne, subtitle_ne), output_path))
+    except Exception as exc:  # noqa: BLE001
+        result["error"] = f"{type(exc).__name__}: {exc}"
+    result["seconds"] = time.perf_counter() - started
+    return result
+
+
+class CardRenderer:
+    """Renders cards off the calling thread.
+
+    With more than one worker, jobs go to a pool of processes (drawing and
+    JPEG encoding are CPU-bound and hold the GIL) that warm up as soon as
+    the renderer is created; with one, submit() renders inline. submit()
+    returns a Future of {"path", "seconds", "error", "bytes", "sha256",
+    "quality"} (see write_card) -- a failed render reports its error there
+    instead of raising.
+    """
+
+    def __init__(self, workers=None):
+        workers = config.CARD_WORKERS if workers is None else workers
+        # More processes than cores only adds start-up time.
+        workers = min(workers, os.cpu_count() or 1)
+        self._pool = None
+        if workers > 1:
+            # spawn, not fork: the caller usually has fetch and caption
+            # threads running.
+            self._pool = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=_warm_up,
+            )
+            # Start every worker now instead of on the first card.
+            for _ in range(workers):
+                self._pool.submit(time.sleep, 0)
+
+    def submit(self, headline_ne, subtitle_ne, output_path):
+        job = (headline_ne, subtitle_ne, output_path)
+        if self._pool is None:
+            future = Future()
+            future.set_result(_render(job))
+            return future
+        return self._pool.submit(_render, job)
+
+    def close(self):
+        if self._pool is not None:
+            self._pool.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def result_of(future):
+    """A submitted job's result, also when the worker process itself died."""
+    try:
+        return future.result()
+    except Exception as exc:  # noqa: BLE001
+        return {
+            "path": None, "seconds": 0.0, "error": f"{type(exc).__name__}: {exc}",
+            "bytes": 0, "sha256": None, "quality": None,
+        }
+
+
+def generate_cards(batch, workers=None):
+    """Render (headline_ne, subtitle_ne, output_path) jobs, up to `workers`
+    (default CARD_WORKERS) at a time. Returns one result per job, in order
+    (see CardRenderer); error is None for a card that was written."""
+    batch = list(batch)
+    workers = config.CARD_WORKERS if workers is None else workers
+    with CardRenderer(min(workers, len(batch))) as renderer:
+        futures = [renderer.submit(*job) for job in batch]
+        results = [result_of(future) for future in futures]
+    for job, result in zip(batch, results):
+        result["path"] = job[2]
+    return results
@@ -0,0 +1,182 @@
+"""Index of the rendered cards in CARDS_DIR.
+
+prepare() used to find old cards to delete by globbing the directory and
+sorting every file by mtime -- and after a git checkout every mtime is the
+checkout time, so the order was effectively random. The manifest
+(CARD_MANIFEST_FILE, committed with the cards) lists them instead, oldest
+first, with slug, path, creation time, size and sha256:
+
+- prune() pops from the front until the store is within MAX_CARD_FILES and
+  MAX_CARD_DIR_BYTES, one O(1) step per card;
+- add() registers a freshly rendered card, and if the same bytes are
+  already stored, drops the new file and points the card at the existing one;
+- `path in store` tells publish() whether a card exists without touching
+  the filesystem; it only falls back to checking the file (with a warning)
+  for a card the manifest doesn't know.
+
+The manifest is written one card per line, so a run's commit diff is just
+the cards it added and pruned.
+
+A tree without a manifest is indexed once from the files on disk, dated by
+the history records they were posted for where possible (a card's slug is
+the start of its story's hash) and by mtime otherwise.
+"""
+
+import glob
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+
+from . import config
+
+
+def _sha256_file(path):
+    with open(path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def _slug(path):
+    return os.path.splitext(os.path.basename(path))[0]
+
+
+class CardStore:
+    def __init__(self, path, cards_dir, max_files, max_bytes, posted_at=None):
+        self.path = path
+        self.cards_dir = cards_dir
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.total_bytes = 0
+        self._cards = OrderedDict()  # slug -> entry, oldest first
+        self._by_hash = {}           # sha256 -> path of the file with those bytes
+        self._refs = {}              # path -> number of cards using that file
+        self._dirty = False
+        self._load(posted_at or {})
+
+    def _index(self, entry):
+        self._cards[entry["slug"]] = entry
+        path = entry["path"]
+        if path not in self._refs:
+            self._refs[path] = 0
+            self._by_hash[entry["sha256"]] = path
+            self.total_bytes += entry["bytes"]
+        self._refs[path] += 1
+
+    def _unindex(self, slug):
+        """Forget a card; returns its file's path if no other card uses it."""
+        entry = self._cards.pop(slug)
+        path = entry["path"]
+        self._refs[path] -= 1
+        if self._refs[path] > 0:
+            return None
+        del self._refs[path]
+        if self._by_hash.get(entry["sha256"]) == path:
+            del self._by_hash[entry["sha256"]]
+        self.total_bytes -= entry["bytes"]
+        return path
+
+    def _load(self, posted_at):
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, "r", encoding="utf-8") as f:
+                    for entry in json.load(f):
+                        self._index(entry)
+                return
+            except (json.JSONDecodeError, OSError, KeyError, TypeError) as exc:
+                print(f"[cards] Rebuilding unreadable {self.path}: {exc}")
+                self._cards, self._by_hash, self._refs, self.total_bytes = OrderedDict(), {}, {}, 0
+        files = glob.glob(f"{self.cards_dir}/*.jpg") + glob.glob(f"{self.cards_dir}/*.webp")
+        created = {path: posted_at.get(_slug(path)) or os.path.getmtime(path) for path in files}
+        for path in sorted(files, key=created.get):
+            self._index({
+                "slug": _slug(path),
+                "path": path,
+                "created": created[path],
+                "bytes": os.path.getsize(path),
+                "sha256": _sha256_file(path),
+            })
+        if files:
+            print(f"[cards] Indexed {len(files)} existing card(s) into {self.path}")
+        self._dirty = True
+
+    def __contains__(self, path):
+        return path in self._refs
+
+    def __len__(self):
+        return len(self._cards)
+
+    def add(self, path, size, sha256):
+        """Register the card just written to `path` (`size` bytes with hash
+        `sha256`). Returns the path to post it from: `path` itself, or an
+        existing card with the same bytes, in which case the new file is
+        removed."""
+        slug = _slug(path)
+        if slug in self._cards:
+            # Re-rendered: the card counts as new again.
+            stale = self._unindex(slug)
+            if stale and stale != path:
+                self._remove(stale)
+        if path in self._refs:
+            # Other cards were deduplicated onto this file; if it now holds
+            # different bytes, they have lost their image.
+            sharing = [s for s, e in self._cards.items() if e["path"] == path]
+            if self._cards[sharing[0]]["sha256"] != sha256:
+                for other in sharing:
+                    self._unindex(other)
+        existing = self._by_hash.get(sha256)
+        if existing and existing != path:
+            self._remove(path)
+            path = existing
+        self._index({"slug": slug, "path": path, "created": time.time(), "bytes": size, "sha256": sha256})
+        self._dirty = True
+        return path
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def prune(self, keep=None, max_bytes=None):
+        """Drop the oldest cards until at most `keep` cards (default
+        MAX_CARD_FILES) and `max_bytes` bytes (default MAX_CARD_DIR_BYTES,
+        0 = no byte limit) are left. Returns how many were dropped."""
+        keep = keep or self.max_files
+        max_bytes = self.max_bytes if max_bytes is None else max_bytes
+        dropped = 0
+        while self._cards and (len(self._cards) > keep or (max_bytes and self.total_bytes > max_bytes)):
+            slug = next(iter(self._cards))
+            path = self._unindex(slug)
+            if path:
+                self._remove(path)
+            dropped += 1
+        if dropped:
+            self._dirty = True
+        return dropped
+
+    def save(self):
+        if not self._dirty:
+            return
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write("[\n")
+            f.write(",\n".join(json.dumps(entry, sort_keys=True) for entry in self._cards.values()))
+            f.write("\n]\n")
+        os.replace(tmp_path, self.path)
+        self._dirty = False
+
+
+def load_card_store(history=None):
+    """The card store; `history` (a HistoryIndex) dates the cards if the
+    manifest has to be rebuilt from the files on disk."""
+    posted_at = {}
+    if history is not None:
+        posted_at = {
+            r["hash"][:16]: r.get("posted_at")
+            for r in history.records if r.get("card_posted") and r.get("hash")
+        }
+    return CardStore(
+        config.CARD_MANIFEST_FILE, config.CARDS_DIR, config.MAX_CARD_FILES, config.MAX_CARD_DIR_BYTES, posted_at,
+    )
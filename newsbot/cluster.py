@@ -0,0 +1,214 @@
+"""Cross-feed near-duplicate story clustering.
+
+The same event usually turns up in OnlineKhabar, Setopati, Ratopati and
+Nagarik at once, each with its own link (so its own dedupe hash) and a
+slightly different headline. Captioning every copy wastes an LLM call and a
+digest bullet per copy, so prepare() groups them first and only captions one
+representative per group.
+
+Stories are compared by the Jaccard similarity of their normalised title
+words. MinHash signatures with LSH banding find candidate pairs without
+comparing every story with every other one, and candidates are then
+confirmed with the exact Jaccard score. Titles only, not summaries: summary
+length and boilerplate vary far more between outlets than the facts do, and
+the post history (which we also match against) only keeps titles.
+"""
+
+import hashlib
+import html
+import random
+import re
+import time
+from collections import defaultdict
+
+from . import config
+from .dedupe import item_hash
+
+# Latin letters/digits and the Devanagari block, minus the danda/double danda
+# (U+0964/U+0965) which are sentence punctuation, not part of words. \w alone
+# would split Devanagari words at every vowel sign.
+_TOKEN_RE = re.compile(r"[a-z0-9ऀ-ॣ०-ॿ]+")
+_TAG_RE = re.compile(r"<[^>]+>")
+
+STOPWORDS = {
+    "a", "an", "the", "of", "in", "on", "at", "to", "for", "and", "or", "is", "are", "was",
+    "were", "be", "by", "with", "as", "from", "after", "over", "into", "its", "it", "his", "her",
+    "र", "तथा", "पनि", "नै", "यो", "त्यो", "छ", "छन्", "हो", "थियो", "भएको", "गरेको", "गर्न",
+    "गर्ने", "लागि", "भने", "अब", "एक",
+}
+
+# Nepali case markers and plural suffixes are written attached to the word
+# ("सरकारले", "सरकारको", "सरकारलाई"), so strip the common ones to compare stems.
+NEPALI_SUFFIXES = sorted(
+    ["ले", "लाई", "को", "का", "की", "मा", "बाट", "सँग", "संग", "हरू", "हरु", "द्वारा", "भन्दा", "देखि", "सम्म", "बीच", "बिच"],
+    key=len, reverse=True,
+)
+
+NUM_PERM = 32
+LSH_BANDS = 16
+_ROWS = NUM_PERM // LSH_BANDS
+_PRIME = (1 << 61) - 1
+_rng = random.Random(20240815)
+_PERMS = [(_rng.randrange(1, _PRIME), _rng.randrange(0, _PRIME)) for _ in range(NUM_PERM)]
+
+
+def _stem(word):
+    for suffix in NEPALI_SUFFIXES:
+        if word.endswith(suffix) and len(word) > len(suffix) + 1:
+            return word[: -len(suffix)]
+    return word
+
+
+def tokens(text):
+    text = html.unescape(_TAG_RE.sub(" ", text or "")).lower()
+    # Chandrabindu and anusvara are used interchangeably (काठमाडौँ / काठमाडौं).
+    text = text.replace("ँ", "ं")
+    words = (_stem(w) for w in _TOKEN_RE.findall(text))
+    return {w for w in words if len(w) > 1 and w not in STOPWORDS}
+
+
+def has_token(text, wanted):
+    """Whether any token of `text` is in `wanted` (a set built with tokens()).
+    tokens() strips at most one case marker, so "राजीनामाको" comes out as
+    "राजीनामा" while "राजीनामा" itself loses its "मा"; each token is also
+    tried with one more suffix off."""
+    return any(t in wanted or _stem(t) in wanted for t in tokens(text))
+
+
+def _token_hash(token):
+    return int.from_bytes(hashlib.blake2b(token.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+def minhash(token_set):
+    hashes = [_token_hash(t) for t in token_set] or [0]
+    return [min((a * h + b) % _PRIME for h in hashes) for a, b in _PERMS]
+
+
+def jaccard(a, b):
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+class StoryClusterer:
+    """Incremental near-duplicate index over story titles.
+
+    add(key, title) indexes one story under `key` (anything hashable); match
+    (title) returns the key of the most similar indexed story at or above
+    `threshold`, or None.
+    """
+
+    def __init__(self, threshold=None):
+        self.threshold = config.CLUSTER_THRESHOLD if threshold is None else threshold
+        self._buckets = defaultdict(list)
+        self._tokens = []
+        self._keys = []
+
+    def _bands(self, signature):
+        return [(b, tuple(signature[b * _ROWS:(b + 1) * _ROWS])) for b in range(LSH_BANDS)]
+
+    def match(self, title):
+        toks = tokens(title)
+        if not toks:
+            return None
+        candidates = set()
+        for band in self._bands(minhash(toks)):
+            candidates.update(self._buckets.get(band, ()))
+        best, best_score = None, self.threshold
+        for idx in sorted(candidates):
+            score = jaccard(toks, self._tokens[idx])
+            if score >= best_score:
+                best, best_score = self._keys[idx], score
+        return best
+
+    def add(self, key, title):
+        toks = tokens(title)
+        if not toks:
+            return
+        idx = len(self._keys)
+        self._keys.append(key)
+        self._tokens.append(toks)
+        for band in self._bands(minhash(toks)):
+            self._buckets[band].append(idx)
+
+
+class StoryClusters:
+    """Incremental cluster_stories(), for items that arrive a feed at a time.
+
+    offer(item) returns True if `item` starts a new group (it becomes that
+    group's representative), or False if it is a near-duplicate -- then
+    item["duplicate_of"] is set, and for an in-run match the item is also
+    appended to the representative's "alternates". promote() hands a group
+    to its next member when the representative can't be used.
+    """
+
+    def __init__(self, history_records=()):
+        self._index = StoryClusterer()
+        self.representatives = []
+        self._members = []  # per group: the in-run duplicates, in offer order
+        self._group = {}    # id(representative) -> group index
+        cutoff = time.time() - config.CLUSTER_HISTORY_HOURS * 3600
+        for record in history_records:
+            if record.get("posted_at", 0) >= cutoff and record.get("title"):
+                self._index.add(("history", record["hash"]), record["title"])
+
+    def offer(self, item):
+        if id(item) in self._group:
+            return True  # already a representative (see promote())
+        match = self._index.match(item["title"])
+        if match is None:
+            item["alternates"] = []
+            self._group[id(item)] = len(self.representatives)
+            self.representatives.append(item)
+            self._members.append([])
+            self._index.add(("run", len(self.representatives) - 1), item["title"])
+            return True
+
+        kind, ref = match
+        if kind == "history":
+            item["duplicate_of"] = ref
+        else:
+            rep = self.representatives[ref]
+            item["duplicate_of"] = item_hash(rep)
+            rep["alternates"].append({
+                "source": item["source"], "title": item["title"], "link": item["link"], "hash": item_hash(item),
+            })
+            self._members[ref].append(item)
+        return False
+
+    def promote(self, rep):
+        """`rep` could not be captioned: make the first of its in-run
+        duplicates the group's representative instead, with the remaining
+        alternates. Returns the promoted item, or None if there is none."""
+        group = self._group.pop(id(rep), None)
+        if group is None or not self._members[group]:
+            return None
+        new = self._members[group].pop(0)
+        new_hash = item_hash(new)
+        del new["duplicate_of"]
+        new["alternates"] = [alt for alt in rep["alternates"] if alt["hash"] != new_hash]
+        rep["alternates"] = []
+        for member in self._members[group]:
+            member["duplicate_of"] = new_hash
+        self.representatives[group] = new
+        self._group[id(new)] = group
+        return new
+
+
+def cluster_stories(items, history_records=(), key=None):
+    """Group near-duplicate `items` and drop the ones already covered.
+
+    Items are visited best-first by `key` (main.rank_key), so the first story
+    of each group is its representative, and later stories are only matched
+    against representatives (not against each other, which lets unrelated
+    look-alike stories such as two different road accidents chain together).
+    Every other member is attached to it as representative["alternates"]
+    (source/title/link/hash dicts) and given item["duplicate_of"] =
+    representative hash. Items matching a story posted within the last
+    CLUSTER_HISTORY_HOURS get duplicate_of that record's hash instead.
+
+    Returns (representatives, duplicates), both in `key` order.
+    """
+    clusters = StoryClusters(history_records)
+    duplicates = [item for item in (sorted(items, key=key) if key else items) if not clusters.offer(item)]
+    return clusters.representatives, duplicates
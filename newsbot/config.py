@@ -19,6 +19,11 @@ def _collect_keys(prefix, max_n=10):
     return keys
 
 
+def _float_list(name, default):
+    """A comma-separated env var as a list of floats ("10" or "10,15")."""
+    return [float(v) for v in os.environ.get(name, default).split(",") if v.strip()]
+
+
 # Multiple keys per provider are supported (GEMINI_API_KEY, GEMINI_API_KEY2, ...
 # and GROQ_API_KEY, GROQ_API_KEY2, ...) so that if one key hits a rate limit or
 # quota error, caption.py can fall back to the next one automatically.
@@ -42,6 +47,37 @@ GROQ_MODEL = os.environ.get("GROQ_MODEL", "openai/gpt-oss-120b")
 GROQ_MODEL_FALLBACK = os.environ.get("GROQ_MODEL_FALLBACK", "openai/gpt-oss-20b")
 GROQ_MODELS = [m for m in [GROQ_MODEL, GROQ_MODEL_FALLBACK] if m]
 
+# Free-tier limits per key (see ratelimit.py), as requests and tokens per
+# minute; a comma list sets key #1, #2, ... separately, 0 means unlimited.
+# Up to CAPTION_WORKERS caption requests run at once, and a request that
+# would have to wait more than RATE_LIMIT_MAX_WAIT_SECONDS for its key moves
+# on to the next key instead.
+GEMINI_RPM = _float_list("GEMINI_RPM", "10")
+GEMINI_TPM = _float_list("GEMINI_TPM", "250000")
+GROQ_RPM = _float_list("GROQ_RPM", "30")
+GROQ_TPM = _float_list("GROQ_TPM", "8000")
+CAPTION_WORKERS = int(os.environ.get("CAPTION_WORKERS", "4"))
+RATE_LIMIT_MAX_WAIT_SECONDS = float(os.environ.get("RATE_LIMIT_MAX_WAIT_SECONDS", "30"))
+
+# Each LLM request gives up after LLM_TIMEOUT_SECONDS. With LLM_PREWARM on,
+# prepare() opens the provider connections while the feeds are downloading.
+LLM_TIMEOUT_SECONDS = float(os.environ.get("LLM_TIMEOUT_SECONDS", "60"))
+LLM_PREWARM = os.environ.get("LLM_PREWARM", "1") == "1"
+# Send every Gemini/Groq request to a local stand-in server instead, e.g.
+# http://127.0.0.1:8765 from python -m newsbot.bench.mock_llm.
+LLM_MOCK_URL = os.environ.get("LLM_MOCK_URL", "")
+# Ask for native JSON output (Gemini response schema, Groq JSON mode) instead
+# of relying on the prompt alone.
+STRUCTURED_OUTPUT = os.environ.get("STRUCTURED_OUTPUT", "1") == "1"
+
+# Caption provider health (see provider_health.py): how long a key/model is
+# skipped after a quota error, after a "model not found" or rejected-key
+# error, or after HEALTH_FAILURE_THRESHOLD other failures in a row.
+HEALTH_QUOTA_COOLDOWN_MINUTES = float(os.environ.get("HEALTH_QUOTA_COOLDOWN_MINUTES", "30"))
+HEALTH_MODEL_COOLDOWN_HOURS = float(os.environ.get("HEALTH_MODEL_COOLDOWN_HOURS", "24"))
+HEALTH_FAILURE_THRESHOLD = int(os.environ.get("HEALTH_FAILURE_THRESHOLD", "3"))
+HEALTH_FAILURE_COOLDOWN_MINUTES = float(os.environ.get("HEALTH_FAILURE_COOLDOWN_MINUTES", "10"))
+
 META_ACCESS_TOKEN = os.environ.get("META_ACCESS_TOKEN", "")
 FB_PAGE_ID = os.environ.get("FB_PAGE_ID", "")
 IG_ACCOUNT_ID = os.environ.get("IG_ACCOUNT_ID", "")
@@ -55,6 +91,23 @@ GITHUB_REF_NAME = os.environ.get("GITHUB_REF_NAME", "main")
 # single workflow run (cost control -- the workflow runs every 30 minutes).
 MAX_ITEMS_PER_RUN = int(os.environ.get("MAX_ITEMS_PER_RUN", "15"))
 
+# How those MAX_ITEMS_PER_RUN stories are picked (see selection.py): quota
+# lists are "group:count" pairs, where a group is a region ("nepal" also
+# covers "nepal_sports"), a category ("tech", which Nepali stories get too
+# -- "region:tech" means the foreign tech feeds only) or a source ("BBC
+# World"). Both are off by default; e.g. "nepal:5" and "region:tech:4,intl:4".
+# Every FRESHNESS_DECAY_HOURS of age drops a story one priority step (0
+# disables the decay).
+SELECT_MIN_QUOTAS = os.environ.get("SELECT_MIN_QUOTAS", "")
+SELECT_MAX_QUOTAS = os.environ.get("SELECT_MAX_QUOTAS", "")
+FRESHNESS_DECAY_HOURS = float(os.environ.get("FRESHNESS_DECAY_HOURS", "24"))
+# Top-tier stories are captioned as soon as their feed arrives, but only up
+# to URGENT_ITEMS_PER_FEED per feed and URGENT_ITEMS_PER_RUN in all; the
+# rest of MAX_ITEMS_PER_RUN is picked across every feed once the fetch is
+# done. URGENT_ITEMS_PER_RUN=0 waits for every feed.
+URGENT_ITEMS_PER_RUN = int(os.environ.get("URGENT_ITEMS_PER_RUN", "5"))
+URGENT_ITEMS_PER_FEED = int(os.environ.get("URGENT_ITEMS_PER_FEED", "2"))
+
 # Safety cap on card (photo) posts queued in a single run.
 MAX_POSTS_PER_RUN = int(os.environ.get("MAX_POSTS_PER_RUN", "6"))
 
@@ -67,9 +120,110 @@ MAX_CARD_POSTS_PER_DAY = int(os.environ.get("MAX_CARD_POSTS_PER_DAY", "5"))
 # Only consider RSS items published within this many hours.
 MAX_ITEM_AGE_HOURS = int(os.environ.get("MAX_ITEM_AGE_HOURS", "36"))
 
+# Near-duplicate clustering (see cluster.py): two stories are the same event
+# when their normalised title words overlap at least this much (Jaccard), and
+# a new story is also dropped if it matches one posted in the last
+# CLUSTER_HISTORY_HOURS.
+CLUSTER_THRESHOLD = float(os.environ.get("CLUSTER_THRESHOLD", "0.5"))
+CLUSTER_HISTORY_HOURS = int(os.environ.get("CLUSTER_HISTORY_HOURS", "48"))
+
+# Feeds are downloaded in parallel (see fetch_news.fetch_all). Each request
+# gets its own connect/read timeout, and the whole fetch stage gives up on
+# any feed still running after FETCH_DEADLINE_SECONDS so one slow server
+# can't hold up the run. FETCH_WORKERS=1 fetches serially.
+FETCH_WORKERS = int(os.environ.get("FETCH_WORKERS", "8"))
+FEED_CONNECT_TIMEOUT = float(os.environ.get("FEED_CONNECT_TIMEOUT", "5"))
+FEED_READ_TIMEOUT = float(os.environ.get("FEED_READ_TIMEOUT", "15"))
+FETCH_DEADLINE_SECONDS = float(os.environ.get("FETCH_DEADLINE_SECONDS", "45"))
+# Each feed remembers the newest published_ts it has shown us; entries older
+# than that minus this many hours are skipped without any work. The margin
+# covers feeds that back-date or re-order entries.
+FEED_HIGH_WATER_SAFETY_HOURS = float(os.environ.get("FEED_HIGH_WATER_SAFETY_HOURS", "12"))
+
+# Offline feed fixtures: "record" saves every downloaded feed under
+# FEED_FIXTURES_DIR, "replay" reads feeds back from there instead of the
+# network. Empty (the default) means normal live fetching.
+FEED_FIXTURES_MODE = os.environ.get("FEED_FIXTURES_MODE", "")
+FEED_FIXTURES_DIR = os.environ.get("FEED_FIXTURES_DIR", "newsbot/bench/fixtures")
+
+# Where the posted-story history lives -- see history_store.py. "jsonl" (the
+# default) appends a line per new/changed record instead of rewriting the
+# whole file on every save; "sqlite" keeps it in an indexed SQLite file;
+# "json" is the original single posted_history.json.
+HISTORY_BACKEND = os.environ.get("HISTORY_BACKEND", "jsonl")
 HISTORY_FILE = "newsbot/data/posted_history.json"
+HISTORY_LOG_FILE = "newsbot/data/posted_history.jsonl"
+HISTORY_DB_FILE = "newsbot/data/posted_history.sqlite3"
+# ETag / Last-Modified / newest published_ts per feed, for conditional GETs.
+FEED_STATE_FILE = "newsbot/data/feed_state.json"
 CARDS_DIR = "newsbot/data/cards"
 PENDING_FILE = "newsbot/data/pending.json"
 DIGEST_FILE = "newsbot/data/digest_today.json"
 MAX_HISTORY_ENTRIES = 4000
+# The jsonl history log is rewritten down to MAX_HISTORY_ENTRIES lines once it
+# grows this fraction past it (with updates and trimmed records).
+HISTORY_COMPACT_SLACK = 0.25
+
+# Optional Bloom filter that keeps remembering story hashes after they age out
+# of the MAX_HISTORY_ENTRIES window, at a fixed size on disk. Off by default
+# (0 bits); 1048576 bits (128 KiB) holds ~100k stories at ~1% false positives.
+HISTORY_BLOOM_FILE = "newsbot/data/seen_hashes.bloom"
+HISTORY_BLOOM_BITS = int(os.environ.get("HISTORY_BLOOM_BITS", "0"))
+HISTORY_BLOOM_HASHES = 7
+# Rendered cards are indexed in CARD_MANIFEST_FILE (see card_store.py); the
+# oldest are deleted once there are more than MAX_CARD_FILES of them or they
+# take up more than MAX_CARD_DIR_BYTES (0 = no byte limit).
+CARD_MANIFEST_FILE = "newsbot/data/card_manifest.json"
 MAX_CARD_FILES = 500
+MAX_CARD_DIR_BYTES = int(os.environ.get("MAX_CARD_DIR_BYTES", "50000000"))
+
+# Cards are rendered in this many worker processes (1 renders each card
+# inline). prepare() only renders once every story is captioned, and a run
+# has at most MAX_POSTS_PER_RUN cards of a few tens of ms each -- less than
+# it takes to spawn and warm up a pool -- so the default is inline.
+CARD_WORKERS = int(os.environ.get("CARD_WORKERS", "1"))
+
+# Cards are saved at CARD_QUALITY, or at the highest quality down to
+# CARD_MIN_QUALITY that keeps them under CARD_MAX_BYTES (0 = no budget):
+# every card is committed to the repo and fetched by Meta from there.
+# JPEGs get optimised Huffman tables, plus progressive encoding and the
+# CARD_SUBSAMPLING chroma subsampling as set here. CARD_FORMAT=webp is a
+# third the size, but Instagram only accepts JPEG image URLs.
+CARD_FORMAT = os.environ.get("CARD_FORMAT", "jpeg").lower()
+CARD_MAX_BYTES = int(os.environ.get("CARD_MAX_BYTES", "120000"))
+CARD_QUALITY = int(os.environ.get("CARD_QUALITY", "90"))
+CARD_MIN_QUALITY = int(os.environ.get("CARD_MIN_QUALITY", "70"))
+CARD_PROGRESSIVE = os.environ.get("CARD_PROGRESSIVE", "1") == "1"
+CARD_SUBSAMPLING = os.environ.get("CARD_SUBSAMPLING", "4:2:0")
+
+# Feed summaries are stripped of HTML and boilerplate and cut at a sentence
+# boundary to about this many tokens before they go into a prompt (0 keeps
+# the whole cleaned summary).
+SUMMARY_TOKEN_BUDGET = int(os.environ.get("SUMMARY_TOKEN_BUDGET", "200"))
+
+# Stories are captioned up to CAPTION_BATCH_SIZE per LLM request (1 turns
+# batching off), as long as the request stays under roughly
+# CAPTION_BATCH_TOKEN_BUDGET prompt tokens.
+CAPTION_BATCH_SIZE = int(os.environ.get("CAPTION_BATCH_SIZE", "5"))
+CAPTION_BATCH_TOKEN_BUDGET = int(os.environ.get("CAPTION_BATCH_TOKEN_BUDGET", "6000"))
+
+# Stories the local pre-scoring (significance.py) rates below this
+# probability of being card-worthy -- or any story once today's card slots
+# are used up -- get a short digest-line-only prompt. 0 sends every story
+# the full prompt.
+SIGNIFICANCE_THRESHOLD = float(os.environ.get("SIGNIFICANCE_THRESHOLD", "0.35"))
+SIGNIFICANCE_WEIGHTS_FILE = "newsbot/data/significance_weights.json"
+# Share of the stories under the threshold that get the full prompt anyway,
+# so `python -m newsbot.significance --train` sees verdicts on stories the
+# scorer would have passed over. 0 turns exploring off.
+SIGNIFICANCE_EXPLORE_RATE = float(os.environ.get("SIGNIFICANCE_EXPLORE_RATE", "0.05"))
+
+# Parsed LLM caption results, keyed by model + rendered prompt (see
+# caption_cache.py), so re-runs and retries don't pay for the same story
+# twice. CAPTION_CACHE_TTL_HOURS=0 disables the cache. Not committed -- the
+# workflow keeps it in actions/cache.
+CAPTION_CACHE_FILE = "newsbot/data/caption_cache.jsonl"
+CAPTION_CACHE_TTL_HOURS = float(os.environ.get("CAPTION_CACHE_TTL_HOURS", "72"))
+CAPTION_CACHE_MAX_ENTRIES = int(os.environ.get("CAPTION_CACHE_MAX_ENTRIES", "2000"))
+# Per key/model call outcomes and latency, keys stored as fingerprints only.
+PROVIDER_HEALTH_FILE = "newsbot/data/provider_health.json"
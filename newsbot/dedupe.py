@@ -1,8 +1,8 @@
 import hashlib
-import json
 import os
 
 from . import config
+from .history_store import open_store
 
 
 def _normalize(item):
@@ -12,29 +12,138 @@ def _normalize(item):
 
 
 def item_hash(item):
-    return hashlib.sha256(_normalize(item).encode("utf-8")).hexdigest()
+    # Memoised on the item: prepare asks for the same item's hash at several
+    # stages (dedupe, clustering, history), but only ever computes it once.
+    h = item.get("_hash")
+    if h is None:
+        h = item["_hash"] = hashlib.sha256(_normalize(item).encode("utf-8")).hexdigest()
+    return h
+
+
+_store = None
+
+
+def _history_store():
+    # One store per process: it remembers what it loaded so that
+    # save_history() only writes the records that changed.
+    global _store
+    if _store is None:
+        _store = open_store()
+    return _store
 
 
 def load_history():
-    if not os.path.exists(config.HISTORY_FILE):
-        return {"posted": []}
-    try:
-        with open(config.HISTORY_FILE, "r", encoding="utf-8") as f:
-            return json.load(f)
-    except (json.JSONDecodeError, OSError):
-        return {"posted": []}
+    return {"posted": _history_store().load()}
 
 
 def save_history(history):
-    os.makedirs(os.path.dirname(config.HISTORY_FILE), exist_ok=True)
     posted = history.get("posted", [])
     if len(posted) > config.MAX_HISTORY_ENTRIES:
         posted = posted[-config.MAX_HISTORY_ENTRIES:]
     history["posted"] = posted
-    with open(config.HISTORY_FILE, "w", encoding="utf-8") as f:
-        json.dump(history, f, ensure_ascii=False, indent=2)
+    _history_store().save(posted)
+
+
+class BloomFilter:
+    """Fixed-size set of item hashes that never forgets and never grows.
+
+    Used to remember stories that have already been trimmed out of the
+    MAX_HISTORY_ENTRIES history window. It can answer "seen" for a story that
+    never was (at roughly 1% with ~10 bits per stored hash), which only ever
+    means skipping one story -- it never lets a real duplicate through.
+    """
+
+    def __init__(self, num_bits, num_hashes, bits=None):
+        self.num_bits = num_bits
+        self.num_hashes = num_hashes
+        self.bits = bits if bits is not None else bytearray((num_bits + 7) // 8)
+
+    def _positions(self, h):
+        # `h` is already a sha256 hex digest, so slices of it are independent
+        # uniform values -- double hashing on two of them is enough.
+        h1 = int(h[:16], 16)
+        h2 = int(h[16:32], 16) | 1
+        return [(h1 + i * h2) % self.num_bits for i in range(self.num_hashes)]
+
+    def add(self, h):
+        for pos in self._positions(h):
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def __contains__(self, h):
+        return all(self.bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(h))
+
+
+def load_bloom():
+    bloom = BloomFilter(config.HISTORY_BLOOM_BITS, config.HISTORY_BLOOM_HASHES)
+    try:
+        with open(config.HISTORY_BLOOM_FILE, "rb") as f:
+            data = f.read()
+    except OSError:
+        return bloom
+    if len(data) == len(bloom.bits):
+        bloom.bits = bytearray(data)
+    else:
+        print("[dedupe] Bloom filter size changed, starting a fresh one")
+    return bloom
+
+
+def save_bloom(bloom):
+    os.makedirs(os.path.dirname(config.HISTORY_BLOOM_FILE), exist_ok=True)
+    with open(config.HISTORY_BLOOM_FILE, "wb") as f:
+        f.write(bytes(bloom.bits))
+
+
+class HistoryIndex:
+    """Hash-indexed view over history["posted"], built once per run.
+
+    Membership checks and lookups by hash are O(1) instead of rebuilding the
+    seen-hash set for every item. add() keeps the index and the underlying
+    history list in step, so the history dict can still be passed straight to
+    save_history(). With the optional Bloom filter, hashes stay "seen" after
+    they have been trimmed from the history file.
+    """
+
+    def __init__(self, history, bloom=None):
+        self.history = history
+        self.records = history.setdefault("posted", [])
+        self._by_hash = {p["hash"]: p for p in self.records}
+        self.bloom = bloom
+        if bloom is not None:
+            for h in self._by_hash:
+                bloom.add(h)
+
+    def __contains__(self, h):
+        return h in self._by_hash or (self.bloom is not None and h in self.bloom)
+
+    def __len__(self):
+        return len(self._by_hash)
+
+    def seen(self, item):
+        return item_hash(item) in self
+
+    def get(self, h, default=None):
+        return self._by_hash.get(h, default)
+
+    def add(self, record):
+        self.records.append(record)
+        self._by_hash[record["hash"]] = record
+        if self.bloom is not None:
+            self.bloom.add(record["hash"])
+
+
+def load_history_index():
+    bloom = load_bloom() if config.HISTORY_BLOOM_BITS else None
+    return HistoryIndex(load_history(), bloom)
+
+
+def save_history_index(index):
+    save_history(index.history)
+    if index.bloom is not None:
+        save_bloom(index.bloom)
 
 
 def already_posted(item, history):
+    if isinstance(history, HistoryIndex):
+        return history.seen(item)
     seen = {p["hash"] for p in history.get("posted", [])}
     return item_hash(item) in seen
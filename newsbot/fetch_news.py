@@ -1,10 +1,18 @@
+import json
+import os
+import queue
+import re
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import feedparser
+import requests
 
 from . import config
 from .rss_sources import FEEDS
 
+USER_AGENT = "Mozilla/5.0 (compatible; TrendingTodayBot/1.0; +https://github.com/sudip-parajuli/news-automation)"
+
 SPORTS_KEYWORDS = [
     "cricket", "football", "soccer", "volleyball", "kabaddi", "sport", "sports",
     "olympic", "sea games", "anfa", "psl", "ipl", "world cup", "worldcup",
@@ -34,55 +42,339 @@ FAKE_NEWS_KEYWORDS = [
 ]
 
 
+# classify() priority order: the first category with any keyword hit wins.
+# (A "tech" feed region short-circuits to "tech" before any matching.)
+CATEGORY_KEYWORDS = [
+    ("tech", TECH_KEYWORDS),
+    ("fake_news", FAKE_NEWS_KEYWORDS),
+    ("viral", VIRAL_KEYWORDS),
+    ("sports", SPORTS_KEYWORDS),
+    ("politics", POLITICS_KEYWORDS),
+]
+
+
+def _trie_pattern(words):
+    """Build a regex alternation shaped like a character trie, e.g.
+    ["sport", "sports", "soccer"] -> "s(?:occer|port(?:s)?)". re tries at
+    most one branch per character, so the cost of a match attempt depends on
+    the keyword length, not on how many keywords there are."""
+    trie = {}
+    for word in words:
+        node = trie
+        for ch in word:
+            node = node.setdefault(ch, {})
+        node[""] = True
+
+    def walk(node):
+        ends_here = "" in node
+        branches = [re.escape(ch) + walk(child) for ch, child in sorted(node.items()) if ch]
+        if not branches:
+            return ""
+        body = branches[0] if len(branches) == 1 else "(?:" + "|".join(branches) + ")"
+        # Greedy: try the longer keyword first, fall back to ending here.
+        if ends_here:
+            return "(?:" + body + ")?"
+        return body
+
+    return walk(trie)
+
+
+def _build_classifier():
+    keyword_categories = {}
+    for category, keywords in CATEGORY_KEYWORDS:
+        for k in keywords:
+            keyword_categories.setdefault(k.lower(), set()).add(category)
+    # A match is always the longest keyword starting at that position, so
+    # fold in the categories of every keyword that is a prefix of it (e.g.
+    # "sport" inside "sports"), which would have matched there too.
+    for k in keyword_categories:
+        for i in range(1, len(k)):
+            keyword_categories[k] |= keyword_categories.get(k[:i], set())
+    pattern = re.compile(_trie_pattern(keyword_categories))
+    return pattern, {k: frozenset(v) for k, v in keyword_categories.items()}
+
+
+_KEYWORD_RE, _KEYWORD_CATEGORIES = _build_classifier()
+
+
+def _matched_categories(text):
+    """Every category with a keyword somewhere in `text`, in one left-to-right
+    scan. Resuming one character after each match start (rather than after
+    its end) keeps overlapping keywords such as "प्रधानमन्त्री" / "मन्त्री"."""
+    found = set()
+    search = _KEYWORD_RE.search
+    match = search(text)
+    while match:
+        found |= _KEYWORD_CATEGORIES[match.group()]
+        match = search(text, match.start() + 1)
+    return found
+
+
+def keyword_categories(title, summary):
+    """Every category with a keyword hit in the title or summary."""
+    return _matched_categories(f"{title} {summary}".lower())
+
+
 def classify(title, summary, region=None):
-    text = f"{title} {summary}".lower()
-    if region == "tech" or any(k in text for k in TECH_KEYWORDS):
+    if region == "tech":
         return "tech"
-    if any(k in text for k in FAKE_NEWS_KEYWORDS):
-        return "fake_news"
-    if any(k in text for k in VIRAL_KEYWORDS):
-        return "viral"
-    if any(k in text for k in SPORTS_KEYWORDS):
-        return "sports"
-    if any(k in text for k in POLITICS_KEYWORDS):
-        return "politics"
+    found = _matched_categories(f"{title} {summary}".lower())
+    for category, _ in CATEGORY_KEYWORDS:
+        if category in found:
+            return category
     return "general"
 
 
-def fetch_all(max_age_hours=None):
+def classify_many(items):
+    """classify() every item dict (title/summary/region keys) in one go and
+    return the categories in the same order."""
+    return [classify(it.get("title") or "", it.get("summary") or "", it.get("region")) for it in items]
+
+
+def load_feed_state():
+    """Per-feed HTTP cache validators (ETag / Last-Modified) and the newest
+    published_ts seen, keyed by feed name. Persisted next to the post
+    history so every 30-minute run can send conditional requests."""
+    if not os.path.exists(config.FEED_STATE_FILE):
+        return {}
+    try:
+        with open(config.FEED_STATE_FILE, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (json.JSONDecodeError, OSError):
+        return {}
+
+
+def save_feed_state(state):
+    os.makedirs(os.path.dirname(config.FEED_STATE_FILE), exist_ok=True)
+    with open(config.FEED_STATE_FILE, "w", encoding="utf-8") as f:
+        json.dump(state, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+def release_feed_state(state, items):
+    """Forget the cache validators of every feed that still has items in
+    `items` (unseen stories this run didn't get to, e.g. because of
+    MAX_ITEMS_PER_RUN), and pull its high-water mark back to the oldest of
+    them. Otherwise the next run would get a 304 for that feed, or skip those
+    entries as already seen, and never get to the leftover stories."""
+    for item in items:
+        entry = state.get(item["source"])
+        if entry:
+            entry.pop("etag", None)
+            entry.pop("last_modified", None)
+            entry["newest_ts"] = min(entry.get("newest_ts") or item["published_ts"], item["published_ts"])
+
+
+def _fixture_paths(feed):
+    slug = re.sub(r"[^a-z0-9]+", "_", feed["name"].lower()).strip("_")
+    base = os.path.join(config.FEED_FIXTURES_DIR, slug)
+    return f"{base}.xml", f"{base}.headers.json"
+
+
+def _replay_fixture(feed):
+    body_path, headers_path = _fixture_paths(feed)
+    with open(body_path, "rb") as f:
+        body = f.read()
+    headers = {"content-location": feed["url"]}
+    if os.path.exists(headers_path):
+        with open(headers_path, "r", encoding="utf-8") as f:
+            headers.update(json.load(f))
+    return feedparser.parse(body, response_headers=headers), headers
+
+
+def _record_fixture(feed, body, headers):
+    body_path, headers_path = _fixture_paths(feed)
+    os.makedirs(config.FEED_FIXTURES_DIR, exist_ok=True)
+    with open(body_path, "wb") as f:
+        f.write(body)
+    with open(headers_path, "w", encoding="utf-8") as f:
+        json.dump(headers, f, ensure_ascii=False, indent=2, sort_keys=True)
+
+
+def _download(feed, validators=None):
+    """GET one feed with explicit connect/read timeouts.
+
+    feedparser.parse(url) has no timeout of its own, so one stalled server
+    used to hang the whole run. We download with requests instead and hand
+    feedparser the raw bytes plus the response headers it needs for encoding
+    detection and relative-URL resolution.
+
+    If `validators` (a feed state entry) is given, the request is made
+    conditional; a 304 Not Modified returns (None, headers) without parsing.
+
+    FEED_FIXTURES_MODE=record also saves every response body + headers under
+    FEED_FIXTURES_DIR; =replay serves the feed from those files instead of
+    the network (used by newsbot.bench.ingest and for offline testing).
+    """
+    if config.FEED_FIXTURES_MODE == "replay":
+        return _replay_fixture(feed)
+
+    req_headers = {"User-Agent": USER_AGENT}
+    if validators and validators.get("url") == feed["url"]:
+        if validators.get("etag"):
+            req_headers["If-None-Match"] = validators["etag"]
+        if validators.get("last_modified"):
+            req_headers["If-Modified-Since"] = validators["last_modified"]
+
+    resp = requests.get(
+        feed["url"],
+        headers=req_headers,
+        timeout=(config.FEED_CONNECT_TIMEOUT, config.FEED_READ_TIMEOUT),
+    )
+    headers = {k.lower(): v for k, v in resp.headers.items()}
+    if resp.status_code == 304:
+        return None, headers
+    resp.raise_for_status()
+    headers.setdefault("content-location", resp.url)
+    if config.FEED_FIXTURES_MODE == "record":
+        _record_fixture(feed, resp.content, headers)
+    return feedparser.parse(resp.content, response_headers=headers), headers
+
+
+def _fetch_feed(feed, cutoff, validators=None):
+    """Fetch and parse a single feed into item dicts, in the feed's own entry
+    order, plus the feed's new state entry (None if it should be left as
+    is). Never raises -- a bad feed just yields ([], None).
+
+    Entries older than the feed's high-water mark (the newest published_ts
+    seen in earlier runs) minus FEED_HIGH_WATER_SAFETY_HOURS were handled
+    before, so they are dropped here before any work is done on them. Items
+    are not classified yet -- see classify_many().
+    """
+    items = []
+    try:
+        parsed, headers = _download(feed, validators)
+        if parsed is None:
+            print(f"[fetch_news] {feed['name']}: not modified since last run")
+            return items, None
+        if getattr(parsed, "bozo", 0) and not parsed.entries:
+            print(f"[fetch_news] {feed['name']}: no entries parsed, skipping")
+            return items, None
+
+        newest_ts = 0
+        if validators and validators.get("url") == feed["url"]:
+            newest_ts = validators.get("newest_ts") or 0
+        floor = max(cutoff, newest_ts - config.FEED_HIGH_WATER_SAFETY_HOURS * 3600)
+        for entry in parsed.entries:
+            published = entry.get("published_parsed") or entry.get("updated_parsed")
+            ts = time.mktime(published) if published else time.time()
+            if ts < floor:
+                continue
+
+            title = (entry.get("title") or "").strip()
+            summary = (entry.get("summary") or entry.get("description") or "").strip()
+            link = (entry.get("link") or "").strip()
+            if not title or not link:
+                continue
+
+            if published:
+                # Undated entries get "now" as their timestamp; they must not
+                # drag the mark past dated entries that are merely late.
+                newest_ts = max(newest_ts, ts)
+            items.append({
+                "source": feed["name"],
+                "lang": feed["lang"],
+                "region": feed["region"],
+                "title": title,
+                "summary": summary,
+                "link": link,
+                "published_ts": ts,
+            })
+
+        state = {"url": feed["url"], "newest_ts": newest_ts}
+        if headers.get("etag"):
+            state["etag"] = headers["etag"]
+        if headers.get("last-modified"):
+            state["last_modified"] = headers["last-modified"]
+        return items, state
+    except Exception as exc:  # noqa: BLE001 - one bad feed must not kill the run
+        print(f"[fetch_news] Failed to fetch {feed['name']}: {exc}")
+    return items, None
+
+
+def stream_feeds(max_age_hours=None, workers=None, deadline=None, feed_state=None):
+    """Yield (feed, items) for each feed in FEEDS as soon as it is fetched.
+    The items are not classified -- run classify_many() on the ones that
+    survive dedupe.
+
+    Feeds are downloaded in parallel on a bounded thread pool and handed over
+    through a queue, so the caller can start working on the first feeds
+    while the slow ones are still downloading. The deadline applies to the
+    downloads only: any feed still downloading when `deadline` seconds have
+    passed is dropped for this run, but one that finished in time is always
+    handed over, however long the caller spends on the feeds before it.
+    workers=1 fetches serially in the calling thread, in FEEDS order.
+
+    Pass the dict from load_feed_state() as `feed_state` to send conditional
+    requests: unchanged feeds answer 304 and are skipped without parsing,
+    entries below each feed's high-water mark are skipped, and the dict is
+    updated in place with each feed's new validators and mark (the caller
+    saves it with save_feed_state()).
+    """
     max_age_hours = max_age_hours or config.MAX_ITEM_AGE_HOURS
+    workers = config.FETCH_WORKERS if workers is None else workers
+    deadline = config.FETCH_DEADLINE_SECONDS if deadline is None else deadline
     cutoff = time.time() - max_age_hours * 3600
-    items = []
+    state = feed_state if feed_state is not None else {}
+    give_up_at = time.monotonic() + deadline
 
-    for feed in FEEDS:
-        try:
-            parsed = feedparser.parse(feed["url"])
-            if getattr(parsed, "bozo", 0) and not parsed.entries:
-                print(f"[fetch_news] {feed['name']}: no entries parsed, skipping")
+    if workers <= 1:
+        # Only time spent downloading counts towards the deadline here.
+        downloading = 0.0
+        for feed in FEEDS:
+            if downloading >= deadline:
+                print(f"[fetch_news] {feed['name']}: fetch deadline of {deadline:.0f}s passed, skipping")
                 continue
-            for entry in parsed.entries:
-                published = entry.get("published_parsed") or entry.get("updated_parsed")
-                ts = time.mktime(published) if published else time.time()
-                if ts < cutoff:
-                    continue
-
-                title = (entry.get("title") or "").strip()
-                summary = (entry.get("summary") or entry.get("description") or "").strip()
-                link = (entry.get("link") or "").strip()
-                if not title or not link:
-                    continue
-
-                items.append({
-                    "source": feed["name"],
-                    "lang": feed["lang"],
-                    "region": feed["region"],
-                    "title": title,
-                    "summary": summary,
-                    "link": link,
-                    "published_ts": ts,
-                    "category": classify(title, summary, feed["region"]),
-                })
-        except Exception as exc:  # noqa: BLE001 - one bad feed must not kill the run
-            print(f"[fetch_news] Failed to fetch {feed['name']}: {exc}")
+            started = time.monotonic()
+            feed_items, new_state = _fetch_feed(feed, cutoff, state.get(feed["name"]))
+            downloading += time.monotonic() - started
+            if new_state is not None:
+                state[feed["name"]] = new_state
+            yield feed, feed_items
+        return
+
+    # Unbounded: a producer must never wait on a consumer that is busy
+    # captioning (results are one feed's items each, a few dozen at most).
+    results = queue.Queue()
+
+    def produce(feed, validators):
+        result = _fetch_feed(feed, cutoff, validators)
+        results.put((feed, result, time.monotonic()))
+
+    pool = ThreadPoolExecutor(max_workers=min(workers, len(FEEDS)) or 1, thread_name_prefix="fetch")
+    try:
+        for feed in FEEDS:
+            pool.submit(produce, feed, state.get(feed["name"]))
+        remaining = {feed["name"] for feed in FEEDS}
+        while remaining:
+            try:
+                feed, (feed_items, new_state), finished_at = results.get(
+                    timeout=max(0.0, give_up_at - time.monotonic()),
+                )
+            except queue.Empty:
+                for name in sorted(remaining):
+                    print(f"[fetch_news] {name}: fetch deadline of {deadline:.0f}s passed, skipping")
+                break
+            if finished_at > give_up_at:
+                continue  # downloaded after the deadline: counts as missed
+            remaining.discard(feed["name"])
+            if new_state is not None:
+                state[feed["name"]] = new_state
+            yield feed, feed_items
+    finally:
+        # Don't block on stragglers: each one is still bounded by its own
+        # read timeout, we just stop waiting for its result.
+        pool.shutdown(wait=False, cancel_futures=True)
+
 
+def fetch_all(max_age_hours=None, workers=None, deadline=None, feed_state=None):
+    """Fetch every feed in FEEDS (see stream_feeds()) and return all of their
+    recent items at once, classified, always in FEEDS order (then feed order)
+    regardless of which download finished first."""
+    by_feed = {
+        feed["name"]: feed_items
+        for feed, feed_items in stream_feeds(max_age_hours, workers, deadline, feed_state)
+    }
+    items = [item for feed in FEEDS for item in by_feed.get(feed["name"], [])]
+    for item, category in zip(items, classify_many(items)):
+        item["category"] = category
     return items
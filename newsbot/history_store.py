@@ -0,0 +1,245 @@
+"""Storage backends for the posted-story history.
+
+The history is committed and pushed by the workflow every 30 minutes, so the
+cost of each save (and the size of its git diff) matters. Three backends are
+available, picked with HISTORY_BACKEND:
+
+  json    the original posted_history.json, rewritten in full on every save
+  jsonl   an append-only log: each save appends one line per new or changed
+          record, and the log is compacted once it outgrows the history cap
+  sqlite  a SQLite file with indexes on hash and posted_at; each save upserts
+          only the new or changed rows
+
+Every backend has the same two methods: load() returns the records oldest
+first (at most MAX_HISTORY_ENTRIES of them), and save(records) persists
+them. Each store remembers what it loaded, so save() writes only the records
+that were added or changed since then.
+
+Switching from json is a one-shot migration (migrate_history), which also
+runs automatically the first time a new backend finds no file of its own
+but the legacy JSON file is present:
+
+  python -m newsbot.history_store --to jsonl
+"""
+
+import argparse
+import json
+import os
+import sqlite3
+
+from . import config
+
+
+def _load_legacy_records(path):
+    if not os.path.exists(path):
+        return []
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f).get("posted", [])
+    except (json.JSONDecodeError, OSError):
+        return []
+
+
+class _SnapshotStore:
+    """Remembers a copy of every record as last loaded/saved, so subclasses
+    can write just the difference."""
+
+    def __init__(self, path):
+        self.path = path
+        self._snapshot = {}
+
+    def _remember(self, records):
+        self._snapshot = {r["hash"]: dict(r) for r in records}
+        return records
+
+    def _changed(self, records):
+        return [r for r in records if self._snapshot.get(r["hash"]) != r]
+
+
+class JsonHistoryStore(_SnapshotStore):
+    def load(self):
+        return self._remember(_load_legacy_records(self.path)[-config.MAX_HISTORY_ENTRIES:])
+
+    def save(self, records):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump({"posted": records}, f, ensure_ascii=False, indent=2)
+        self._remember(records)
+
+
+class JsonlHistoryStore(_SnapshotStore):
+    """One JSON record per line, last line for a hash wins. Records keep the
+    position of their first line, so load order matches insertion order."""
+
+    def __init__(self, path):
+        super().__init__(path)
+        self._lines = 0
+
+    def _replay(self):
+        by_hash = {}
+        lines = skipped = 0
+        with open(self.path, "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    record = json.loads(line)
+                    by_hash[record["hash"]] = record
+                except (json.JSONDecodeError, KeyError, TypeError):
+                    # A torn line from an interrupted append; the rest of
+                    # the log is still good.
+                    skipped += 1
+                    continue
+                lines += 1
+        if skipped:
+            print(f"[history] Skipped {skipped} unreadable line(s) in {self.path}")
+        return list(by_hash.values()), lines
+
+    def _end_line(self):
+        """If an interrupted append left the log without a final newline,
+        add one, so the next record doesn't get glued onto the torn line."""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb+") as f:
+            if f.seek(0, os.SEEK_END) == 0:
+                return
+            f.seek(-1, os.SEEK_END)
+            if f.read(1) != b"\n":
+                f.write(b"\n")
+
+    def load(self):
+        if not os.path.exists(self.path):
+            self._lines = 0
+            return self._remember([])
+        records, self._lines = self._replay()
+        return self._remember(records[-config.MAX_HISTORY_ENTRIES:])
+
+    def save(self, records):
+        changed = self._changed(records)
+        if self._lines + len(changed) > config.MAX_HISTORY_ENTRIES * (1 + config.HISTORY_COMPACT_SLACK):
+            self.compact(records)
+            return
+        if changed:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            self._end_line()
+            with open(self.path, "a", encoding="utf-8") as f:
+                for record in changed:
+                    f.write(json.dumps(record, ensure_ascii=False, sort_keys=True) + "\n")
+            self._lines += len(changed)
+        self._remember(records)
+
+    def compact(self, records):
+        """Rewrite the log as exactly one line per live record."""
+        records = records[-config.MAX_HISTORY_ENTRIES:]
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            for record in records:
+                f.write(json.dumps(record, ensure_ascii=False, sort_keys=True) + "\n")
+        os.replace(tmp_path, self.path)
+        self._lines = len(records)
+        self._remember(records)
+        print(f"[history] Compacted {self.path} to {len(records)} record(s)")
+
+
+class SqliteHistoryStore(_SnapshotStore):
+    def _connect(self):
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        conn = sqlite3.connect(self.path)
+        conn.execute(
+            "CREATE TABLE IF NOT EXISTS posted ("
+            " seq INTEGER PRIMARY KEY AUTOINCREMENT,"
+            " hash TEXT NOT NULL UNIQUE,"
+            " posted_at REAL,"
+            " record TEXT NOT NULL)"
+        )
+        conn.execute("CREATE INDEX IF NOT EXISTS posted_posted_at ON posted (posted_at)")
+        return conn
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return self._remember([])
+        conn = self._connect()
+        try:
+            rows = conn.execute(
+                "SELECT record FROM (SELECT seq, record FROM posted ORDER BY seq DESC LIMIT ?) ORDER BY seq",
+                (config.MAX_HISTORY_ENTRIES,),
+            ).fetchall()
+        finally:
+            conn.close()
+        return self._remember([json.loads(r[0]) for r in rows])
+
+    def save(self, records):
+        changed = self._changed(records)
+        conn = self._connect()
+        try:
+            with conn:
+                conn.executemany(
+                    "INSERT INTO posted (hash, posted_at, record) VALUES (?, ?, ?)"
+                    " ON CONFLICT (hash) DO UPDATE SET posted_at = excluded.posted_at, record = excluded.record",
+                    [
+                        (r["hash"], r.get("posted_at"), json.dumps(r, ensure_ascii=False, sort_keys=True))
+                        for r in changed
+                    ],
+                )
+                conn.execute(
+                    "DELETE FROM posted WHERE seq NOT IN (SELECT seq FROM posted ORDER BY seq DESC LIMIT ?)",
+                    (config.MAX_HISTORY_ENTRIES,),
+                )
+        finally:
+            conn.close()
+        self._remember(records)
+
+
+BACKENDS = {
+    "json": (JsonHistoryStore, lambda: config.HISTORY_FILE),
+    "jsonl": (JsonlHistoryStore, lambda: config.HISTORY_LOG_FILE),
+    "sqlite": (SqliteHistoryStore, lambda: config.HISTORY_DB_FILE),
+}
+
+
+def open_store(backend=None):
+    backend = backend or config.HISTORY_BACKEND
+    if backend not in BACKENDS:
+        raise ValueError(f"Unknown HISTORY_BACKEND {backend!r}, expected one of {sorted(BACKENDS)}")
+    cls, path = BACKENDS[backend]
+    store = cls(path())
+    if backend != "json" and not os.path.exists(store.path) and os.path.exists(config.HISTORY_FILE):
+        migrate_history(store)
+    return store
+
+
+def migrate_history(store, legacy_path=None, remove_legacy=True):
+    """Copy every record from the legacy posted_history.json into `store`,
+    check they all read back, then delete the legacy file so the two can't
+    drift apart."""
+    legacy_path = legacy_path or config.HISTORY_FILE
+    # The legacy file can hold the same hash more than once; keep one record
+    # per hash (first position, last contents) like the jsonl log does.
+    by_hash = {}
+    for record in _load_legacy_records(legacy_path):
+        by_hash[record["hash"]] = record
+    records = list(by_hash.values())[-config.MAX_HISTORY_ENTRIES:]
+    store.load()
+    store.save(records)
+    migrated = store.load()
+    if [r["hash"] for r in migrated] != [r["hash"] for r in records]:
+        raise RuntimeError(f"History migration to {store.path} did not round-trip, keeping {legacy_path}")
+    print(f"[history] Migrated {len(records)} record(s) from {legacy_path} to {store.path}")
+    if remove_legacy:
+        os.remove(legacy_path)
+    return store
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Migrate posted_history.json to another history backend")
+    parser.add_argument("--to", choices=[b for b in BACKENDS if b != "json"], default="jsonl")
+    parser.add_argument("--keep-legacy", action="store_true", help="don't delete posted_history.json afterwards")
+    args = parser.parse_args()
+    cls, path = BACKENDS[args.to]
+    migrate_history(cls(path()), remove_legacy=not args.keep_legacy)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,115 @@
+"""Tolerant parsing of JSON written by an LLM.
+
+Models that are asked for "ONLY a JSON object" still regularly wrap it in a
+code fence, add a sentence before or after it, leave a trailing comma or a
+// comment in, use Python's True/False/None, quote with smart quotes, or run
+out of tokens halfway through a string. loads() fixes those defects, in
+order of how invasive the fix is, and only raises if the text still isn't
+JSON after all of them -- so a reply with a cosmetic defect doesn't cost
+another request to a different key or provider.
+"""
+
+import json
+import re
+
+_FENCE_RE = re.compile(r"^\s*```[a-zA-Z]*\s*|\s*```\s*$")
+_SMART_QUOTES = str.maketrans({"“": '"', "”": '"', "„": '"', "″": '"'})
+_PY_LITERALS = {"True": "true", "False": "false", "None": "null"}
+
+
+def _first_value(text):
+    """Decode the first JSON value in `text`, ignoring anything around it."""
+    start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=-1)
+    if start < 0:
+        raise ValueError("no JSON object or array in text")
+    value, _ = json.JSONDecoder().raw_decode(text[start:])
+    return value
+
+
+def _clean(text):
+    """One pass over `text` that keeps string contents as they are and, outside
+    strings: drops // and /* */ comments, drops commas right before a closing
+    bracket, turns Python literals into JSON ones, and -- if the text stops
+    early -- closes the open brackets. A string cut off by the end of the
+    text is dropped rather than closed (its value becomes null), so a
+    half-written caption fails validation instead of passing as complete."""
+    out = []
+    stack = []
+    in_string = False
+    string_start = 0
+    i, n = 0, len(text)
+    while i < n:
+        ch = text[i]
+        if in_string:
+            out.append(ch)
+            if ch == "\\" and i + 1 < n:
+                out.append(text[i + 1])
+                i += 1
+            elif ch == '"':
+                in_string = False
+            i += 1
+            continue
+        if ch == '"':
+            in_string = True
+            string_start = len(out)
+        elif text.startswith("//", i):
+            end = text.find("\n", i)
+            i = n if end < 0 else end
+            continue
+        elif text.startswith("/*", i):
+            end = text.find("*/", i + 2)
+            i = n if end < 0 else end + 2
+            continue
+        elif ch in "{[":
+            stack.append("}" if ch == "{" else "]")
+        elif ch in "}]":
+            # Drop a trailing comma before the closing bracket.
+            while out and out[-1].isspace():
+                out.pop()
+            if out and out[-1] == ",":
+                out.pop()
+            if stack:
+                stack.pop()
+        elif ch.isascii() and ch.isalpha():
+            # Only Latin letters can start true/None/NaN-style bare words;
+            # str.isalpha() is also true for Devanagari, which would match
+            # nothing below and crash.
+            word = re.match(r"[A-Za-z]+", text[i:]).group(0)
+            out.append(_PY_LITERALS.get(word, word))
+            i += len(word)
+            continue
+        out.append(ch)
+        i += 1
+
+    # Truncated reply: close what was left open.
+    if in_string:
+        del out[string_start:]
+    tail = "".join(out).rstrip()
+    if tail.endswith(","):
+        tail = tail[:-1]
+    elif tail.endswith(":"):
+        tail += " null"
+    return tail + "".join(reversed(stack))
+
+
+def loads(text):
+    """Parse the first JSON object/array in an LLM reply, repairing it if
+    needed. Raises ValueError if nothing usable can be recovered."""
+    text = _FENCE_RE.sub("", text or "")
+    # Skip any prose before the JSON, so its quotes and brackets can't
+    # confuse _clean.
+    start = min((i for i in (text.find("{"), text.find("[")) if i >= 0), default=-1)
+    if start > 0:
+        text = text[start:]
+    attempts = (
+        lambda t: t,
+        _clean,
+        lambda t: _clean(t.translate(_SMART_QUOTES)),
+    )
+    last_err = None
+    for fix in attempts:
+        try:
+            return _first_value(fix(text))
+        except ValueError as exc:  # json.JSONDecodeError is a ValueError
+            last_err = exc
+    raise ValueError(f"Unparseable JSON in model output ({last_err}): {text[:200]!r}")
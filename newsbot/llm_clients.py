@@ -0,0 +1,83 @@
+"""One reusable SDK client per (provider, API key).
+
+Building a genai.Client / Groq client means importing the SDK and, on the
+first request, a fresh TLS connection. Clients are built lazily here, the
+first time a key is actually used, and then shared by every caption call in
+the run (the SDKs keep an HTTP connection pool per client and are safe to
+use from several threads). Every client gets an explicit request timeout
+(LLM_TIMEOUT_SECONDS), so a hung provider costs one timeout, not forever.
+With LLM_MOCK_URL set, both providers talk to that server instead (see
+newsbot/bench/mock_llm.py).
+
+prewarm() builds the clients for the first key/model each provider will be
+asked and opens their connections with a cheap metadata request, in the
+background while the feeds are still downloading.
+"""
+
+import threading
+
+from . import config
+
+
+def _build_gemini(api_key):
+    from google import genai
+    from google.genai import types
+
+    # HttpOptions.timeout is in milliseconds.
+    options = types.HttpOptions(timeout=int(config.LLM_TIMEOUT_SECONDS * 1000))
+    if config.LLM_MOCK_URL:
+        options.base_url = config.LLM_MOCK_URL.rstrip("/") + "/"
+    return genai.Client(api_key=api_key, http_options=options)
+
+
+def _build_groq(api_key):
+    from groq import Groq
+
+    return Groq(api_key=api_key, timeout=config.LLM_TIMEOUT_SECONDS, base_url=config.LLM_MOCK_URL or None)
+
+
+_BUILDERS = {"gemini": _build_gemini, "groq": _build_groq}
+
+# A request that costs no generation quota but goes over the same connection.
+_WARMERS = {
+    "gemini": lambda client, model: client.models.get(model=model),
+    "groq": lambda client, model: client.models.list(),
+}
+
+_clients = {}
+_lock = threading.Lock()
+
+
+def get_client(provider, api_key):
+    with _lock:
+        client = _clients.get((provider, api_key))
+        if client is None:
+            client = _BUILDERS[provider](api_key)
+            _clients[(provider, api_key)] = client
+        return client
+
+
+def _warm(targets):
+    for provider, model, api_key in targets:
+        try:
+            _WARMERS[provider](get_client(provider, api_key), model)
+            print(f"[llm] Warmed up {provider} client for {model}")
+        except Exception as exc:  # noqa: BLE001
+            print(f"[llm] Could not warm up {provider} client for {model}: {exc}")
+
+
+def prewarm(attempts):
+    """Warm the first of each provider's (provider, model, key_index, key)
+    `attempts` on a background thread; returns the thread (or None)."""
+    if not config.LLM_PREWARM:
+        return None
+    targets, seen = [], set()
+    for provider, model, _, api_key in attempts:
+        if provider not in seen:
+            seen.add(provider)
+            targets.append((provider, model, api_key))
+    if not targets:
+        return None
+    thread = threading.Thread(target=_warm, args=(targets,), name="llm-prewarm", daemon=True)
+    thread.start()
+    return thread
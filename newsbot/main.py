@@ -15,7 +15,7 @@ Runs in three phases (see .github/workflows/news_social.yml and
 
   --phase publish   read pending.json -> post each queued card image + caption
                     to Facebook and Instagram (using the now-live raw URL) ->
-                    update newsbot/data/posted_history.json
+                    update the posted history (newsbot/data/posted_history.jsonl)
                     (workflow then commits+pushes the history file)
 
   --phase digest    once a day: read newsbot/data/digest_today.json -> post ONE
@@ -25,22 +25,28 @@ Runs in three phases (see .github/workflows/news_social.yml and
 """
 
 import argparse
-import glob
 import json
 import os
+import random
 import sys
 import time
 import traceback
 from collections import defaultdict
 
 from . import config
-from .card_image import generate_card
-from .dedupe import already_posted, item_hash, load_history, save_history
-from .fetch_news import fetch_all
-from .caption import write_caption
+from .card_image import CardRenderer, card_extension, result_of
+from .card_store import load_card_store
+from .cluster import StoryClusters
+from .dedupe import item_hash, load_history_index, save_history_index
+from .fetch_news import classify_many, load_feed_state, release_feed_state, save_feed_state, stream_feeds
+from .caption import prewarm_clients as prewarm_caption_clients, write_captions
+from .caption_cache import get_cache as get_caption_cache
 from .poster_facebook import post_image as post_facebook_image
 from .poster_facebook import post_text as post_facebook_text
 from .poster_instagram import post_image as post_instagram_image
+from .provider_health import get_board as get_provider_health
+from .selection import parse_quotas, select_top
+from .significance import full_prompt_chance
 
 REGION_PRIORITY = {"nepal": 0, "nepal_sports": 0, "tech": 1, "intl": 1, "intl_sports": 1}
 CATEGORY_PRIORITY = {"tech": 0, "viral": 0, "fake_news": 0, "politics": 0, "sports": 0, "general": 1}
@@ -64,6 +70,19 @@ def rank_key(item):
     )
 
 
+def selection_key(item, now=None):
+    """rank_key with a freshness decay for choosing what to caption: every
+    FRESHNESS_DECAY_HOURS of age counts as one step down the region/category
+    ladder, so a day-old story no longer beats a fresh one just for being in
+    a better tier. FRESHNESS_DECAY_HOURS=0 gives plain rank_key order."""
+    region, category, neg_ts = rank_key(item)
+    tier = region * (max(CATEGORY_PRIORITY.values()) + 2) + category
+    if config.FRESHNESS_DECAY_HOURS > 0:
+        age_hours = max(0.0, ((now or time.time()) + neg_ts) / 3600)
+        tier += age_hours / config.FRESHNESS_DECAY_HOURS
+    return (tier, neg_ts)
+
+
 def build_raw_url(path):
     return f"https://raw.githubusercontent.com/{config.GITHUB_REPOSITORY}/{config.GITHUB_REF_NAME}/{path}"
 
@@ -106,16 +125,6 @@ def build_digest_message(items):
     return "\n".join(lines).strip()
 
 
-def _prune_old_cards(keep=None):
-    keep = keep or config.MAX_CARD_FILES
-    files = sorted(glob.glob(f"{config.CARDS_DIR}/*.jpg"), key=os.path.getmtime)
-    for f in files[:-keep] if len(files) > keep else []:
-        try:
-            os.remove(f)
-        except OSError:
-            pass
-
-
 def _load_digest_items():
     if not os.path.exists(config.DIGEST_FILE):
         return []
@@ -126,96 +135,322 @@ def _load_digest_items():
         return []
 
 
-def prepare():
-    history = load_history()
-    items = fetch_all()
-    print(f"[prepare] Fetched {len(items)} raw items")
+def _history_record(item, item_h, card_posted=False, duplicate_of=None, significant=None):
+    record = {
+        "hash": item_h,
+        "title": item["title"],
+        "link": item["link"],
+        "source": item["source"],
+        "category": item["category"],
+        "posted_at": time.time(),
+        "card_posted": card_posted,
+        "fb_post_id": None,
+        "ig_post_id": None,
+    }
+    if duplicate_of:
+        # Never captioned itself -- a near-duplicate of that story.
+        record["duplicate_of"] = duplicate_of
+    if significant is not None:
+        # The model's own verdict, plus what significance.train() needs to
+        # learn from it.
+        record["significant"] = significant
+        record["region"] = item.get("region")
+        record["published_ts"] = item.get("published_ts")
+        record["full_prompt_chance"] = item.get("full_prompt_chance", 1.0)
+    return record
+
+
+def _is_urgent(item):
+    """Top-tier stories (Nepal region, politics/sports/tech/viral/fake-news)
+    may be captioned the moment their feed arrives instead of waiting for
+    the slowest feed to finish (a few per feed, see prepare())."""
+    return rank_key(item)[:2] == (0, 0)
+
+
+def _digest_line(written):
+    digest_line = written.get("digest_line_ne") or written.get("caption_ne")
+    if not digest_line:
+        raise ValueError(f"Caption has no digest line: {written!r}")
+    return digest_line
+
+
+def _wants_card(written):
+    return bool(written.get("significant")) and bool(written.get("headline_ne") and written.get("caption_ne"))
+
+
+def _queue_card(item, written, pending, render):
+    """Hand the story's card to `render` and queue it for publishing."""
+    item_h = item_hash(item)
+    card_path = f"{config.CARDS_DIR}/{item_h[:16]}{card_extension()}"
+    render(written["headline_ne"], written["caption_ne"], card_path)
+    message = build_message(written["headline_ne"], written["caption_ne"], written.get("hashtags", []), item["link"])
+    pending.append({
+        "hash": item_h,
+        "title": item["title"],
+        "link": item["link"],
+        "source": item["source"],
+        "category": item["category"],
+        "card_path": card_path,
+        "message": message,
+    })
+
+
+def _process_story(item, written, history, digest_items, pending, cards_today, render):
+    """Take one story's caption (`written`, from write_captions), add it to
+    the digest, hand a card for it to `render` (CardRenderer.submit) and
+    queue it if it is significant and the caps allow, and record it (plus
+    its near-duplicate alternates) in history. Returns True if a card was
+    queued; the render itself is checked in _finish_cards(). A digest-only
+    caption (no headline or caption, significant=False) just goes into the
+    digest."""
+    digest_line = _digest_line(written)
+    significant = _wants_card(written)
+
+    item_h = item_hash(item)
+
+    # Every processed story -- significant or not -- gets a one-line
+    # entry in the running end-of-day digest.
+    digest_items.append({
+        "hash": item_h,
+        "digest_line_ne": digest_line,
+        "source": item["source"],
+        "category": item["category"],
+        "link": item["link"],
+    })
+
+    card_posted = False
+    if (
+        significant
+        and cards_today < config.MAX_CARD_POSTS_PER_DAY
+        and len(pending) < config.MAX_POSTS_PER_RUN
+    ):
+        _queue_card(item, written, pending, render)
+        card_posted = True
+
+    # Mark as processed immediately so it's never re-picked-up or
+    # re-added to the digest, whether or not it got a card post.
+    # Only a full caption carries a real verdict from the model.
+    verdict = significant if "headline_ne" in written else None
+    history.add(_history_record(item, item_h, card_posted=card_posted, significant=verdict))
+    for alt in item["alternates"]:
+        history.add(_history_record(dict(alt, category=item["category"]), alt["hash"], duplicate_of=item_h))
+
+    label = "CARD" if card_posted else "digest-only"
+    print(f"[prepare] {label}: {item['source']} | {item['title'][:80]}")
+    return card_posted
+
+
+def _finish_cards(renders, pending, history, cards):
+    """Wait for the cards handed to the renderer and add them to the card
+    store (`cards`), which may point a card at an identical one it already
+    has. A story whose card failed to render is dropped from `pending` and
+    recorded as digest-only. Returns how many failed."""
+    by_path = {entry["card_path"]: entry for entry in pending}
+    failed = set()
+    seconds = 0.0
+    written = 0
+    for card_path, future in renders:
+        result = result_of(future)
+        seconds += result["seconds"]
+        written += result["bytes"]
+        if result["error"]:
+            print(f"[prepare] Card render failed for {card_path}: {result['error']}")
+            failed.add(card_path)
+            continue
+        stored = cards.add(card_path, result["bytes"], result["sha256"])
+        if stored != card_path and card_path in by_path:
+            print(f"[prepare] Card {card_path} is identical to {stored}, reusing it")
+            by_path[card_path]["card_path"] = stored
+    for entry in [e for e in pending if e["card_path"] in failed]:
+        pending.remove(entry)
+        record = history.get(entry["hash"])
+        if record is not None:
+            record["card_posted"] = False
+    if renders:
+        print(
+            f"[prepare] Rendered {len(renders) - len(failed)}/{len(renders)} card(s), "
+            f"{seconds:.2f}s of render time, {written / 1024:.0f} KiB"
+        )
+    return len(failed)
+
 
-    unseen = [it for it in items if not already_posted(it, history)]
-    unseen.sort(key=rank_key)
-    print(f"[prepare] {len(unseen)} unseen items after dedupe")
+def prepare():
+    """Fetch -> dedupe -> cluster -> caption, as a stream.
+
+    Feeds are consumed as they finish downloading. Up to
+    URGENT_ITEMS_PER_FEED of each feed's urgent stories (see _is_urgent),
+    URGENT_ITEMS_PER_RUN in all, are captioned straight away, so LLM time
+    overlaps with the slower feeds still downloading; everything else waits
+    until the fetch is done and the rest of the run's slots are filled by
+    select_top() over every feed (best selection_key first, within the
+    SELECT_*_QUOTAS, which the urgent picks count towards). MAX_ITEMS_PER_RUN is
+    enforced in the one thread that does the captioning. The digest, card
+    and MAX_POSTS_PER_RUN / MAX_CARD_POSTS_PER_DAY decisions are only made
+    once everything is captioned, over all of the run's stories in rank_key
+    order, so the same stories win however the feeds interleave; a card
+    that fails to render gives its slot to the next significant story the
+    caps had left out.
+    """
+    history = load_history_index()
+    feed_state = load_feed_state()
 
     # How many card posts already went out in the last 24 hours -- this is
     # the daily cap that keeps the page from over-posting.
     cutoff = time.time() - 24 * 3600
     cards_today = sum(
-        1 for p in history.get("posted", [])
+        1 for p in history.records
         if p.get("card_posted") and p.get("posted_at", 0) >= cutoff
     )
 
     digest_items = _load_digest_items()
-
     pending = []
     processed = 0
-    for item in unseen:
-        if processed >= config.MAX_ITEMS_PER_RUN:
+    attempted = set()
+    taken = []
+    min_quotas = parse_quotas(config.SELECT_MIN_QUOTAS)
+    max_quotas = parse_quotas(config.SELECT_MAX_QUOTAS)
+    # The render workers only start once there is a card to render: most
+    # runs have none.
+    renderer = None
+    renders = []
+    cards = load_card_store(history)
+
+    def render(headline, subtitle, card_path):
+        nonlocal renderer
+        if renderer is None:
+            renderer = CardRenderer()
+        renders.append((card_path, renderer.submit(headline, subtitle, card_path)))
+
+    captioned = []
+
+    def process(items):
+        # Only caption here: what each story gets is decided at the end.
+        nonlocal processed
+        # Only stories that could still get a card today, and that the local
+        # pre-scoring thinks might deserve one (or a few it doesn't, see
+        # significance.py), get the full prompt.
+        card_slots = cards_today < config.MAX_CARD_POSTS_PER_DAY
+        modes = []
+        for item in items:
+            item["full_prompt_chance"] = full_prompt_chance(item) if card_slots else 0.0
+            modes.append("full" if random.random() < item["full_prompt_chance"] else "digest")
+        for item, written in zip(items, write_captions(items, modes)):
+            attempted.add(id(item))
+            try:
+                if isinstance(written, Exception):
+                    raise written
+                _digest_line(written)
+                captioned.append((item, written))
+                processed += 1
+                taken.append(item)
+            except Exception:
+                print(f"[prepare] Failed to caption item: {item.get('title')}")
+                traceback.print_exc()
+                # Its near-duplicates were waiting on it; the next one gets
+                # a turn instead.
+                promoted = clusters.promote(item)
+                if promoted is not None:
+                    print(f"[prepare] Trying its duplicate instead: {promoted['source']} | {promoted['title'][:80]}")
+                    waiting.append(promoted)
+
+    def retire(dup):
+        # A near-duplicate of a story that is already in history (from an
+        # earlier run, or captioned earlier in this one) is done with now.
+        if dup["duplicate_of"] in history:
+            history.add(_history_record(dup, item_hash(dup), duplicate_of=dup["duplicate_of"]))
+
+    def accept(item):
+        if clusters.offer(item):
+            return True
+        retire(item)
+        return False
+
+    # The same event from several outlets only gets captioned once: the best
+    # ranked copy goes ahead, the rest ride along as its alternates.
+    clusters = StoryClusters(history.records)
+    fetched, unseen, waiting, urgent_used = 0, [], [], 0
+    # Caption clients connect in the background while the feeds download.
+    prewarm_caption_clients()
+    for feed, feed_items in stream_feeds(feed_state=feed_state):
+        fetched += len(feed_items)
+        fresh = [it for it in feed_items if not history.seen(it)]
+        # Only stories that survive dedupe are worth classifying.
+        for item, category in zip(fresh, classify_many(fresh)):
+            item["category"] = category
+        unseen.extend(fresh)
+        # A few of the feed's urgent stories go ahead now, picked like
+        # select_top() picks the rest; the first feed to arrive must not
+        # take the whole run.
+        slots = min(
+            config.URGENT_ITEMS_PER_FEED,
+            config.URGENT_ITEMS_PER_RUN - urgent_used,
+            config.MAX_ITEMS_PER_RUN - processed,
+        )
+        urgent = []
+        if slots > 0:
+            urgent = select_top(
+                [it for it in fresh if _is_urgent(it)], slots, key=selection_key, accept=accept,
+                max_quotas=max_quotas, taken=taken,
+            )
+        picked = {id(it) for it in urgent}
+        waiting.extend(it for it in fresh if id(it) not in picked and "duplicate_of" not in it)
+        if urgent:
+            urgent_used += len(urgent)
+            process(urgent)
+    print(f"[prepare] Fetched {fetched} raw items, {len(unseen)} unseen after dedupe")
+
+    # Only the stories select_top() actually pops get clustered; a failed
+    # caption frees its slot for the next round.
+    while processed < config.MAX_ITEMS_PER_RUN and waiting:
+        picks = select_top(
+            waiting, config.MAX_ITEMS_PER_RUN - processed, key=selection_key, accept=accept,
+            min_quotas=min_quotas, max_quotas=max_quotas, taken=taken,
+        )
+        if not picks:
             break
-        try:
-            written = write_caption(item)
-            headline = written["headline_ne"]
-            caption_text = written["caption_ne"]
-            digest_line = written.get("digest_line_ne") or caption_text
-            significant = bool(written.get("significant"))
-            hashtags = written.get("hashtags", [])
-            processed += 1
-
-            item_h = item_hash(item)
-
-            # Every processed story -- significant or not -- gets a one-line
-            # entry in the running end-of-day digest.
-            digest_items.append({
-                "hash": item_h,
-                "digest_line_ne": digest_line,
-                "source": item["source"],
-                "category": item["category"],
-                "link": item["link"],
-            })
-
-            card_posted = False
-            if (
-                significant
-                and cards_today < config.MAX_CARD_POSTS_PER_DAY
-                and len(pending) < config.MAX_POSTS_PER_RUN
-            ):
-                slug = item_h[:16]
-                card_path = f"{config.CARDS_DIR}/{slug}.jpg"
-                generate_card(headline, caption_text, card_path)
-                message = build_message(headline, caption_text, hashtags, item["link"])
-                pending.append({
-                    "hash": item_h,
-                    "title": item["title"],
-                    "link": item["link"],
-                    "source": item["source"],
-                    "category": item["category"],
-                    "card_path": card_path,
-                    "message": message,
-                })
-                cards_today += 1
-                card_posted = True
-
-            # Mark as processed immediately so it's never re-picked-up or
-            # re-added to the digest, whether or not it got a card post.
-            history.setdefault("posted", []).append({
-                "hash": item_h,
-                "title": item["title"],
-                "link": item["link"],
-                "source": item["source"],
-                "category": item["category"],
-                "posted_at": time.time(),
-                "card_posted": card_posted,
-                "fb_post_id": None,
-                "ig_post_id": None,
-            })
-
-            label = "CARD" if card_posted else "digest-only"
-            print(f"[prepare] {label}: {item['source']} | {item['title'][:80]}")
-        except Exception:
-            print(f"[prepare] Failed to process item: {item.get('title')}")
-            traceback.print_exc()
-            continue
+        process(picks)
+        waiting = [it for it in waiting if id(it) not in attempted and "duplicate_of" not in it]
 
-    _prune_old_cards()
-    save_history(history)
+    # Significant stories the caps left digest-only; a card that fails to
+    # render hands its slot to the next of them.
+    spare = []
+    try:
+        for item, written in sorted(captioned, key=lambda pair: rank_key(pair[0])):
+            try:
+                if _process_story(item, written, history, digest_items, pending, cards_today, render):
+                    cards_today += 1
+                elif _wants_card(written):
+                    spare.append((item, written))
+            except Exception:
+                print(f"[prepare] Failed to process item: {item.get('title')}")
+                traceback.print_exc()
+
+        while renders:
+            done = list(renders)
+            del renders[:]
+            cards_today -= _finish_cards(done, pending, history, cards)
+            while spare and cards_today < config.MAX_CARD_POSTS_PER_DAY and len(pending) < config.MAX_POSTS_PER_RUN:
+                item, written = spare.pop(0)
+                _queue_card(item, written, pending, render)
+                history.get(item_hash(item))["card_posted"] = True
+                cards_today += 1
+                print(f"[prepare] CARD (in place of a failed one): {item['source']} | {item['title'][:80]}")
+    finally:
+        if renderer is not None:
+            renderer.close()
+    pruned = cards.prune()
+    cards.save()
+    if pruned:
+        print(f"[prepare] Pruned {pruned} old card(s), {len(cards)} left ({cards.total_bytes / 1e6:.1f} MB)")
+    save_history_index(history)
+    caption_cache = get_caption_cache()
+    caption_cache.flush()
+    get_provider_health().save()
+
+    # Feeds with unseen stories we didn't get to this run must be re-fetched
+    # in full next time, not answered with a 304.
+    release_feed_state(feed_state, [it for it in unseen if not history.seen(it)])
+    save_feed_state(feed_state)
 
     os.makedirs(os.path.dirname(config.DIGEST_FILE), exist_ok=True)
     with open(config.DIGEST_FILE, "w", encoding="utf-8") as f:
@@ -229,6 +464,8 @@ def prepare():
         f"[prepare] Processed {processed} item(s): {len(pending)} card post(s) queued, "
         f"{len(digest_items)} item(s) waiting in today's digest"
     )
+    stats = caption_cache.stats()
+    print(f"[prepare] Caption cache: {stats['hits']} hit(s), {stats['misses']} miss(es), {stats['entries']} entries")
 
 
 def publish():
@@ -249,11 +486,18 @@ def publish():
         print(f"[publish] Missing required secrets: {missing}. Aborting without posting.")
         sys.exit(1)
 
-    history = load_history()
-    by_hash = {p["hash"]: p for p in history.get("posted", [])}
+    history = load_history_index()
+    cards = load_card_store(history)
     posted = 0
 
     for entry in pending:
+        if entry["card_path"] not in cards:
+            # The manifest may just be behind (e.g. a merge conflict dropped
+            # its update); only the file itself being gone loses the post.
+            print(f"[publish] WARNING: card {entry['card_path']} is not in the card store, checking the file")
+            if not os.path.exists(entry["card_path"]):
+                print(f"[publish] Card {entry['card_path']} is missing, skipping: {entry['title']}")
+                continue
         image_url = build_raw_url(entry["card_path"])
 
         fb_id = None
@@ -272,14 +516,14 @@ def publish():
             print(f"[publish] Instagram post failed for: {entry['title']}")
             traceback.print_exc()
 
-        record = by_hash.get(entry["hash"])
+        record = history.get(entry["hash"])
         if record is not None:
             record["fb_post_id"] = fb_id
             record["ig_post_id"] = ig_id
         if fb_id or ig_id:
             posted += 1
 
-    save_history(history)
+    save_history_index(history)
     try:
         os.remove(config.PENDING_FILE)
     except OSError:
@@ -0,0 +1,163 @@
+"""Health scoreboard for the caption provider chain (keys x models).
+
+Without it, a key that has used up its quota or a model name that has been
+retired is retried for every story in every run, and each attempt costs a
+full request before the chain falls through. The scoreboard remembers, per
+provider/model/key, the recent outcome of each call and how long it took,
+and opens a circuit (skips that attempt until a cool-down passes) when:
+
+  quota / rate-limit errors (429, RESOURCE_EXHAUSTED)  that key+model, for
+                                                       HEALTH_QUOTA_COOLDOWN_MINUTES
+  unknown or retired model (404, model_not_found)      that model on every key,
+                                                       for HEALTH_MODEL_COOLDOWN_HOURS
+  rejected key (401/403, invalid API key)              that key on every model,
+                                                       for HEALTH_MODEL_COOLDOWN_HOURS
+  HEALTH_FAILURE_THRESHOLD other failures in a row     that key+model, for
+                                                       HEALTH_FAILURE_COOLDOWN_MINUTES
+
+Within each model, keys are tried healthiest and fastest first. The state
+is saved to PROVIDER_HEALTH_FILE so the next run starts from what this one
+learned. Keys are only ever stored as a short SHA-256 fingerprint.
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+import time
+
+from . import config
+
+# Recent call outcomes kept per entry (1 = ok, 0 = failed).
+WINDOW = 10
+# Weight of the newest latency sample in the moving average.
+LATENCY_ALPHA = 0.3
+
+
+def fingerprint(api_key):
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()[:12]
+
+
+_MODEL_ERROR_RE = re.compile(r"\b(model_not_found|not_found_error|model_decommissioned)\b")
+
+
+def classify_error(exc):
+    """-> "quota", "model", "auth" or "other"."""
+    status = getattr(exc, "status_code", None) or getattr(exc, "code", None)
+    text = str(exc).lower()
+    if status == 429 or "resource_exhausted" in text or "quota" in text or "rate limit" in text:
+        return "quota"
+    # Only an actual 404 or the providers' model error codes -- "not found"
+    # in some other message (a missing file, a DNS error) must not take a
+    # model out of rotation for HEALTH_MODEL_COOLDOWN_HOURS.
+    if status == 404 or _MODEL_ERROR_RE.search(text):
+        return "model"
+    if status in (401, 403) or "api key not valid" in text or "invalid_api_key" in text:
+        return "auth"
+    return "other"
+
+
+class HealthBoard:
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except (json.JSONDecodeError, OSError) as exc:
+                print(f"[health] Ignoring unreadable {path}: {exc}")
+
+    @staticmethod
+    def _id(provider, model, key):
+        return f"{provider}:{model}:{fingerprint(key) if key else '*'}"
+
+    def _entry(self, entry_id):
+        return self.entries.setdefault(entry_id, {"recent": [], "latency": None, "streak": 0, "open_until": 0})
+
+    def _open_until(self, provider, model, key):
+        return max(
+            self.entries.get(self._id(provider, model, key), {}).get("open_until", 0),
+            self.entries.get(self._id(provider, model, None), {}).get("open_until", 0),
+            self.entries.get(self._id(provider, "*", key), {}).get("open_until", 0),
+        )
+
+    def is_open(self, provider, model, key):
+        with self.lock:
+            return self._open_until(provider, model, key) > time.time()
+
+    def _score(self, provider, model, key):
+        entry = self.entries.get(self._id(provider, model, key), {})
+        recent = entry.get("recent") or [1]
+        failure_rate = 1 - sum(recent) / len(recent)
+        # Keys that fail more often than not go last; among the rest the
+        # faster one goes first. Unknown keys count as healthy and fast.
+        return (failure_rate > 0.5, entry.get("latency") or 0.0)
+
+    def order(self, attempts):
+        """Reorder (provider, model, key_index, key) attempts: model order
+        is kept, keys within a model go healthiest first, and attempts
+        behind an open circuit are dropped. If every circuit is open, the
+        one due to close soonest is still tried."""
+        now = time.time()
+        with self.lock:
+            closed = [a for a in attempts if self._open_until(a[0], a[1], a[3]) <= now]
+            if not closed and attempts:
+                soonest = min(attempts, key=lambda a: self._open_until(a[0], a[1], a[3]))
+                print(f"[health] Every caption provider is cooling down, trying {soonest[0]} {soonest[1]} anyway")
+                return [soonest]
+            position = {(a[0], a[1]): n for n, a in enumerate(attempts)}
+            return sorted(closed, key=lambda a: (position[(a[0], a[1])], self._score(a[0], a[1], a[3])))
+
+    def _record(self, provider, model, key, ok, latency):
+        entry = self._entry(self._id(provider, model, key))
+        entry["recent"] = (entry["recent"] + [1 if ok else 0])[-WINDOW:]
+        if latency is not None:
+            prev = entry["latency"]
+            entry["latency"] = round(latency if prev is None else prev + LATENCY_ALPHA * (latency - prev), 3)
+        entry["streak"] = 0 if ok else entry["streak"] + 1
+        return entry
+
+    def record_success(self, provider, model, key, latency):
+        with self.lock:
+            self._record(provider, model, key, True, latency)["open_until"] = 0
+
+    def record_failure(self, provider, model, key, exc, latency=None):
+        kind = classify_error(exc)
+        now = time.time()
+        with self.lock:
+            entry = self._record(provider, model, key, False, latency)
+            entry["last_error"] = f"{kind}: {str(exc)[:160]}"
+            if kind == "quota":
+                target, cooldown = entry, config.HEALTH_QUOTA_COOLDOWN_MINUTES * 60
+            elif kind == "model":
+                target, cooldown = self._entry(self._id(provider, model, None)), config.HEALTH_MODEL_COOLDOWN_HOURS * 3600
+            elif kind == "auth":
+                target, cooldown = self._entry(self._id(provider, "*", key)), config.HEALTH_MODEL_COOLDOWN_HOURS * 3600
+            elif entry["streak"] >= config.HEALTH_FAILURE_THRESHOLD:
+                target, cooldown = entry, config.HEALTH_FAILURE_COOLDOWN_MINUTES * 60
+            else:
+                return kind
+            target["open_until"] = now + cooldown
+            print(f"[health] {provider} {model}: {kind} error, skipping it for {cooldown / 60:.0f} min")
+        return kind
+
+    def save(self):
+        with self.lock:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, ensure_ascii=False, indent=2, sort_keys=True)
+            os.replace(tmp_path, self.path)
+
+
+_board = None
+
+
+def get_board():
+    global _board
+    if _board is None:
+        _board = HealthBoard(config.PROVIDER_HEALTH_FILE)
+    return _board
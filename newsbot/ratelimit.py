@@ -0,0 +1,104 @@
+"""Client-side rate limiting for the caption providers.
+
+Captions are requested from several threads at once (see
+caption.write_captions), so without a limiter a burst of requests can trip a
+free-tier key's requests-per-minute or tokens-per-minute quota and come back
+as 429s. Every (provider, key) pair gets two token buckets sized from its
+RPM and TPM settings (GEMINI_RPM/GEMINI_TPM, GROQ_RPM/GROQ_TPM); a request
+waits until both buckets can cover it, or -- if that would take longer than
+RATE_LIMIT_MAX_WAIT_SECONDS -- is skipped so the caller can move on to the
+next key.
+"""
+
+import threading
+import time
+
+from . import config
+
+
+class TokenBucket:
+    """Holds up to `capacity` tokens, refilled at `per_minute` per minute.
+
+    reserve() always succeeds and returns how long the caller has to wait
+    before the reservation is covered; the bucket may go negative, which
+    queues later callers behind it.
+    """
+
+    def __init__(self, capacity, per_minute):
+        self.capacity = capacity
+        self.rate = per_minute / 60.0
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount):
+        amount = min(amount, self.capacity)
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            return 0.0 if self.tokens >= 0 else -self.tokens / self.rate
+
+    def refund(self, amount):
+        amount = min(amount, self.capacity)
+        with self.lock:
+            self.tokens = min(self.capacity, self.tokens + amount)
+
+
+class KeyLimiter:
+    def __init__(self, rpm, tpm):
+        self.requests = TokenBucket(rpm, rpm) if rpm > 0 else None
+        self.tokens = TokenBucket(tpm, tpm) if tpm > 0 else None
+
+    def acquire(self, tokens, max_wait):
+        """Block until one request of `tokens` tokens fits; False (without
+        waiting or using anything up) if that would take over max_wait."""
+        waits = []
+        if self.requests:
+            waits.append(self.requests.reserve(1))
+        if self.tokens:
+            waits.append(self.tokens.reserve(tokens))
+        wait = max(waits, default=0.0)
+        if wait > max_wait:
+            if self.requests:
+                self.requests.refund(1)
+            if self.tokens:
+                self.tokens.refund(tokens)
+            return False
+        if wait > 0:
+            time.sleep(wait)
+        return True
+
+
+_LIMITS = {
+    "gemini": lambda: (config.GEMINI_RPM, config.GEMINI_TPM),
+    "groq": lambda: (config.GROQ_RPM, config.GROQ_TPM),
+}
+_limiters = {}
+_limiters_lock = threading.Lock()
+
+
+def _limit_for_key(values, key_index):
+    # One value applies to every key; a comma list gives key #1, #2, ... their
+    # own limits, with the last value repeated for any keys beyond it.
+    if not values:
+        return 0
+    return values[min(key_index, len(values)) - 1]
+
+
+def limiter(provider, key_index):
+    with _limiters_lock:
+        lim = _limiters.get((provider, key_index))
+        if lim is None:
+            rpm, tpm = _LIMITS[provider]()
+            lim = KeyLimiter(_limit_for_key(rpm, key_index), _limit_for_key(tpm, key_index))
+            _limiters[(provider, key_index)] = lim
+        return lim
+
+
+def acquire(provider, key_index, tokens):
+    return limiter(provider, key_index).acquire(tokens, config.RATE_LIMIT_MAX_WAIT_SECONDS)
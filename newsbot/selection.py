@@ -0,0 +1,99 @@
+"""Quota-aware top-K story selection for prepare().
+
+Each run only captions MAX_ITEMS_PER_RUN stories, so fully sorting every
+candidate is wasted work, and a plain "best first" order lets one chatty
+feed (BBC World, say) fill the whole run. select_top() heapifies the
+candidates once (O(n)) and pops only as many as it needs, while honouring
+per-group quotas:
+
+  SELECT_MIN_QUOTAS="nepal:6"       at least 6 Nepal stories per run (if there
+                                    are that many)
+  SELECT_MAX_QUOTAS="tech:3,intl:4" at most 3 tech and 4 international stories
+
+A quota group name matches an item's region ("nepal", "intl_sports"), its
+region family (the part before "_", so "nepal" covers "nepal_sports"), its
+category ("tech", "politics", ...) or its source ("BBC World"). Where a name
+is both -- "tech" is the foreign tech feeds' region and also a category that
+Nepali stories get -- "region:tech" or "category:tech" picks one.
+"""
+
+import heapq
+
+
+def parse_quotas(spec):
+    """ "nepal:6, tech:3" -> {"nepal": 6, "tech": 3}"""
+    quotas = {}
+    for part in (spec or "").split(","):
+        name, sep, count = part.rpartition(":")
+        if sep and name.strip() and count.strip():
+            quotas[name.strip()] = int(count)
+    return quotas
+
+
+def groups_of(item):
+    region = item.get("region") or ""
+    category = item.get("category") or "general"
+    return {
+        region, region.split("_")[0], category, item.get("source") or "",
+        f"region:{region}", f"region:{region.split('_')[0]}", f"category:{category}",
+    }
+
+
+def select_top(candidates, k, key, accept=None, min_quotas=None, max_quotas=None, taken=()):
+    """Return up to `k` of `candidates`, best first by `key`.
+
+    min_quotas are filled first (each from its own group's best items), then
+    the remaining slots go to the best items overall; no pick may take a
+    group past its max_quotas. `taken` are items already chosen earlier in
+    the run -- they count towards the quotas but not towards `k`.
+
+    `accept(item)` is called once per item popped, in `key` order, and only
+    for items that would otherwise be picked; returning False skips it. Use
+    it for per-item work (clustering, etc.) that is wasted on items that
+    never make the cut.
+    """
+    min_quotas = min_quotas or {}
+    max_quotas = max_quotas or {}
+    counts = {}
+    for item in taken:
+        for g in groups_of(item):
+            counts[g] = counts.get(g, 0) + 1
+
+    heap = [(key(item), i, item) for i, item in enumerate(candidates)]
+    heapq.heapify(heap)
+    # Per-group heaps share the same (key, index, item) tuples; they are only
+    # built for groups that have a minimum to fill.
+    group_heaps = {
+        g: [entry for entry in heap if g in groups_of(entry[2])]
+        for g, n in min_quotas.items() if n > counts.get(g, 0)
+    }
+    for h in group_heaps.values():
+        heapq.heapify(h)
+
+    decided = set()
+    selected = []
+
+    def try_pick(entry):
+        _, i, item = entry
+        if i in decided:
+            return False
+        item_groups = groups_of(item)
+        decided.add(i)
+        if any(counts.get(g, 0) >= max_quotas[g] for g in item_groups if g in max_quotas):
+            return False  # counts only grow, so it can never fit later either
+        if accept is not None and not accept(item):
+            return False
+        selected.append(entry)
+        for g in item_groups:
+            counts[g] = counts.get(g, 0) + 1
+        return True
+
+    for g, h in group_heaps.items():
+        while h and len(selected) < k and counts.get(g, 0) < min_quotas[g]:
+            try_pick(heapq.heappop(h))
+
+    while heap and len(selected) < k:
+        try_pick(heapq.heappop(heap))
+
+    selected.sort()
+    return [item for _, _, item in selected]
@@ -0,0 +1,174 @@
+"""Cheap local guess at whether a story will be card-worthy.
+
+The caption prompt asks the model to mark most stories significant=false,
+and those stories only ever show up as one line in the daily digest -- yet
+each one used to get the full headline + caption + digest + hashtags
+generation. score() estimates the chance the model would call a story
+significant from a few local features (the classifier's keyword hits, source
+region, breaking-news words, freshness) with a small logistic model; stories
+under SIGNIFICANCE_THRESHOLD get the much shorter digest-only prompt instead.
+
+The built-in weights are a hand-set starting point. Once the history has
+some stories the model has judged (their records carry "significant"), the
+weights can be fitted to them:
+
+  python -m newsbot.significance --train
+
+which writes SIGNIFICANCE_WEIGHTS_FILE; score() uses that file when present.
+
+Only full-prompt stories come back with a verdict, and those are the ones
+this scorer already rated likely -- trained on them alone, the weights could
+never learn that a low-scoring kind of story is in fact card-worthy. So a
+SIGNIFICANCE_EXPLORE_RATE share of the stories under the threshold get the
+full prompt anyway, their records keep the chance they had of getting it
+("full_prompt_chance"), and train() weights each record by the inverse of
+that chance.
+"""
+
+import argparse
+import json
+import math
+import os
+import time
+
+from . import config
+from .cluster import has_token, tokens
+from .fetch_news import keyword_categories
+
+# Words that usually mean a big or fast-moving story. Matched as whole
+# tokens (cluster.tokens), so "ban" does not fire on "bank" or "Taliban".
+BREAKING_WORDS = [
+    "breaking", "dies", "dead", "killed", "earthquake", "flood", "landslide",
+    "resign", "resigns", "resigned", "arrested", "wins", "final", "record", "ban",
+    "निधन", "मृत्यु", "भूकम्प", "बाढी", "पहिरो", "राजीनामा", "पक्राउ",
+    "विजयी", "फाइनल", "रेकर्ड", "प्रतिबन्ध",
+]
+BREAKING_TOKENS = set().union(*(tokens(word) for word in BREAKING_WORDS))
+
+
+DEFAULT_WEIGHTS = {
+    "bias": -2.0,
+    "region_nepal": 0.6,
+    "cat_politics": 0.9,
+    "cat_sports": 0.8,
+    "cat_tech": 0.8,
+    "cat_viral": 1.0,
+    "cat_fake_news": 1.2,
+    "keyword_hits": 0.4,
+    "breaking": 1.2,
+    "fresh": 0.6,
+}
+
+
+def features(item, now=None):
+    title = item.get("title") or ""
+    summary = item.get("summary") or ""
+    category = item.get("category") or "general"
+    age_hours = max(0.0, ((now or time.time()) - (item.get("published_ts") or 0)) / 3600)
+    feats = {
+        "bias": 1.0,
+        "region_nepal": 1.0 if (item.get("region") or "").startswith("nepal") else 0.0,
+        "keyword_hits": min(len(keyword_categories(title, summary)), 3) / 3,
+        "breaking": 1.0 if has_token(f"{title} {summary}", BREAKING_TOKENS) else 0.0,
+        "fresh": max(0.0, 1 - age_hours / 24),
+    }
+    for name in ("politics", "sports", "tech", "viral", "fake_news"):
+        feats[f"cat_{name}"] = 1.0 if category == name else 0.0
+    return feats
+
+
+def _sigmoid(x):
+    return 1 / (1 + math.exp(-max(-30.0, min(30.0, x))))
+
+
+_weights = None
+
+
+def load_weights():
+    global _weights
+    if _weights is None:
+        _weights = dict(DEFAULT_WEIGHTS)
+        if os.path.exists(config.SIGNIFICANCE_WEIGHTS_FILE):
+            try:
+                with open(config.SIGNIFICANCE_WEIGHTS_FILE, "r", encoding="utf-8") as f:
+                    _weights.update(json.load(f))
+            except (json.JSONDecodeError, OSError) as exc:
+                print(f"[significance] Ignoring unreadable weights file: {exc}")
+    return _weights
+
+
+def score(item, now=None):
+    """Estimated probability (0-1) that the model marks `item` significant."""
+    weights = load_weights()
+    return _sigmoid(sum(weights.get(name, 0.0) * value for name, value in features(item, now).items()))
+
+
+def likely_significant(item, now=None):
+    return score(item, now) >= config.SIGNIFICANCE_THRESHOLD
+
+
+def full_prompt_chance(item, now=None):
+    """Chance that `item` gets the full prompt: 1 if it looks significant,
+    else SIGNIFICANCE_EXPLORE_RATE."""
+    return 1.0 if likely_significant(item, now) else config.SIGNIFICANCE_EXPLORE_RATE
+
+
+def train(records, epochs=300, learning_rate=0.5, l2=0.01):
+    """Fit the weights by plain gradient descent on logistic loss, using
+    history records that carry the model's "significant" verdict. Features
+    are computed as of posting time; records keep no summary, so keyword
+    hits come from the title alone.
+
+    Each record counts 1 / its full_prompt_chance, so the few explored
+    low-scoring stories stand in for all the ones that only got a digest
+    line. Records from before exploration carry no chance and count once:
+    with only those, the fit still just sharpens the current scorer."""
+    labelled = [r for r in records if isinstance(r.get("significant"), bool)]
+    if not labelled:
+        return None
+    rows = [
+        (features(r, now=r.get("posted_at")), 1.0 if r["significant"] else 0.0, 1 / (r.get("full_prompt_chance") or 1.0))
+        for r in labelled
+    ]
+    total_weight = sum(row_weight for _, _, row_weight in rows)
+    weights = dict(DEFAULT_WEIGHTS)
+    for _ in range(epochs):
+        grad = {name: 0.0 for name in weights}
+        for feats, label, row_weight in rows:
+            err = (_sigmoid(sum(weights[n] * v for n, v in feats.items())) - label) * row_weight
+            for name, value in feats.items():
+                grad[name] += err * value
+        for name in weights:
+            # Pull towards the hand-set weights, so features the history has
+            # little evidence about keep a sensible value.
+            penalty = 0.0 if name == "bias" else l2 * (weights[name] - DEFAULT_WEIGHTS[name])
+            weights[name] -= learning_rate * (grad[name] / total_weight + penalty)
+    explored = sum(1 for r in labelled if (r.get("full_prompt_chance") or 1.0) < 1)
+    return {name: round(value, 4) for name, value in weights.items()}, len(labelled), explored
+
+
+def main():
+    from .dedupe import load_history
+
+    parser = argparse.ArgumentParser(description="Fit the significance pre-scoring weights to the history.")
+    parser.add_argument("--train", action="store_true", required=True)
+    parser.parse_args()
+
+    fitted = train(load_history().get("posted", []))
+    if fitted is None:
+        print("[significance] No history records with a significant verdict yet, nothing to train on")
+        return
+    weights, count, explored = fitted
+    os.makedirs(os.path.dirname(config.SIGNIFICANCE_WEIGHTS_FILE), exist_ok=True)
+    with open(config.SIGNIFICANCE_WEIGHTS_FILE, "w", encoding="utf-8") as f:
+        json.dump(weights, f, indent=2, sort_keys=True)
+    print(f"[significance] Fitted weights on {count} record(s), {explored} explored -> {config.SIGNIFICANCE_WEIGHTS_FILE}")
+    if not explored:
+        print(
+            "[significance] None of them scored under the threshold, so the fit only sharpens the "
+            "current scorer; set SIGNIFICANCE_EXPLORE_RATE > 0 to let it learn from the rest"
+        )
+
+
+if __name__ == "__main__":
+    main()